@@ -2,6 +2,7 @@ import click
 
 from spot_detector.commands.detector import detector
 from spot_detector.commands.palette_editor import palette_editor
+from spot_detector.commands.param_tuner import param_tuner
 from spot_detector.commands.remove_hot_pixels import remove_hot_pixels
 
 
@@ -12,4 +13,5 @@ def cli():
 
 cli.add_command(detector)
 cli.add_command(palette_editor)
+cli.add_command(param_tuner)
 cli.add_command(remove_hot_pixels)
@@ -9,8 +9,12 @@ from click import (
 
 # Project files
 from spot_detector.core import detect
-from spot_detector.file_utils import check_img_count
+from spot_detector.file_utils import (
+    ImageIndex, check_img_count, manifest_path
+)
+from spot_detector.memory import available_memory
 from spot_detector.misc import fit_elements
+from spot_detector.result_cache import default_cache_path, default_labels_path
 
 @command()
 @argument(
@@ -56,7 +60,104 @@ from spot_detector.misc import fit_elements
     default=1,
     help="le nombre de processus qui traitent les images. Un processus par "
     "cœur de CPU ou moins pour des performances optimales. Peut être "
-    "limité par la mémoire vive.",
+    "limité par la mémoire vive. 0 : un processus par fil du budget "
+    "(voir --fils-total), ou par cœur sans budget.",
+)
+@option(
+    "--fils-total",
+    "thread_budget",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Le nombre total de fils d'exécution, partagé entre les processus et "
+    "les fils internes d'OpenCV et de BLAS de chacun d'eux, par exemple le "
+    "nombre de cœurs disponibles. Par défaut, aucun budget : les fils "
+    "d'OpenCV et de BLAS ne sont pas limités.",
+)
+@option(
+    "--memoire",
+    "memory",
+    type=click.INT,
+    default=None,
+    help="La mémoire vive que le traitement peut utiliser, en Mo. Les images "
+    "ne sont traitées en parallèle que tant que leur mémoire estimée tient "
+    "dans ce budget, et le nombre de processus est limité en conséquence. "
+    "0 : 80 % de la mémoire disponible.",
+)
+@option(
+    "--threads",
+    "threads",
+    is_flag=True,
+    default=False,
+    help="Traite les images dans des fils d'exécution (threads) d'un seul "
+    "processus plutôt que dans des processus séparés. Démarre plus vite et "
+    "utilise moins de mémoire, -j donne alors le nombre de fils.",
+)
+@option(
+    "--decodeurs",
+    "decoders",
+    type=click.INT,
+    default=0,
+    help="Le nombre de processus qui lisent et décodent les images en avance "
+    "pour les processus de traitement, utile quand les images sont sur un "
+    "disque réseau. Aucun par défaut : chaque processus lit ses images.",
+)
+@option(
+    "--delai-image",
+    "image_timeout",
+    type=click.FloatRange(min=0),
+    default=600.0,
+    help="Le temps maximal de traitement d'une image, en secondes. Un "
+    "processus bloqué plus longtemps sur une image est remplacé, et l'image "
+    "est réessayée puis mise en quarantaine. 0 : pas de limite. Sans effet "
+    "avec --threads.",
+)
+@option(
+    "--reessayer-quarantaine",
+    "retry_quarantined",
+    is_flag=True,
+    default=False,
+    help="Traite de nouveau les images mises en quarantaine lors des "
+    "lancements précédents, listées dans le fichier .quarantaine à côté du "
+    "fichier csv. Par défaut, elles sont ignorées.",
+)
+@option(
+    "--cache/--sans-cache",
+    "use_cache",
+    default=False,
+    help="Reprend les résultats des images déjà traitées avec les mêmes "
+    "paramètres, même déplacées ou renommées, depuis le cache de "
+    "l'utilisateur (~/.cache/spot-detector). Chaque nouvelle image y est "
+    "lue une fois de plus pour calculer son empreinte. Désactivé par défaut.",
+)
+@option(
+    "--cartes-etiquettes",
+    "keep_labels",
+    is_flag=True,
+    default=False,
+    help="Garde dans le cache la carte des étiquettes de chaque image, "
+    "recadrée sur la boîte. Quand seuls les paramètres de détection "
+    "changent, les images ne sont plus ni recadrées ni étiquetées, et seules "
+    "les couleurs dont les paramètres ont changé sont recomptées. Occupe "
+    "environ un octet par pixel.",
+)
+@option(
+    "--dossier-etiquettes",
+    "labels_dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Le dossier des cartes d'étiquettes, par exemple sur un disque local "
+    "rapide. Implique --cartes-etiquettes. Par défaut, dans le cache de "
+    "l'utilisateur.",
+)
+@option(
+    "-b",
+    "--base-de-donnees",
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False),
+    default=None,
+    help="Enregistre les résultats dans une base de données SQLite, à partir "
+    "de laquelle le fichier csv est exporté. Recommandé pour les grandes "
+    "campagnes : la reprise d'un traitement interrompu est immédiate.",
 )
 @option("-y", is_flag=True, flag_value=True, default=False)
 def detector(
@@ -67,6 +168,16 @@ def detector(
     csv_path: str | None,
     y: bool,
     proc: int,
+    db_path: str | None,
+    decoders: int,
+    threads: bool,
+    memory: int | None,
+    thread_budget: int | None,
+    image_timeout: float,
+    retry_quarantined: bool,
+    use_cache: bool,
+    keep_labels: bool,
+    labels_dir: Path | None,
 ) -> None:
 
     if dir is None:
@@ -83,10 +194,15 @@ def detector(
             f"{csv.name} existe déjà. Traiter les images manquantes ?",
             abort=True,
         )
-    img_directories = list(filter(lambda x: x.is_dir(), dir.iterdir()))
-    mismatches, counts = check_img_count(len(depths_list), img_directories)
+    index = ImageIndex(dir, regex, depths_list, manifest=manifest_path(csv))
+    if index.rescanned < len(index.sub_dirs):
+        echo(
+            f"{len(index.sub_dirs) - index.rescanned} dossiers inchangés depuis "
+            f"le dernier lancement, {index.rescanned} dossiers lus."
+        )
+    mismatches, counts = check_img_count(len(depths_list), index)
     if mismatches and not y:
-        bad_dirs = filter(lambda p: p[1] != len(depths_list), zip(img_directories, counts))
+        bad_dirs = filter(lambda p: p[1] != len(depths_list), zip(index.sub_dirs, counts))
         dir_and_count = list(map(lambda p: f"{p[0].name}: {p[1]}", bad_dirs))
         lines = fit_elements(dir_and_count)
         if mismatches > 1:
@@ -105,4 +221,29 @@ def detector(
             )
         confirm("Continuer ?", abort=True)
 
-    detect(dir, depths_list, csv, regex, config, proc)
+    if labels_dir is not None:
+        keep_labels = True
+    elif keep_labels:
+        labels_dir = default_labels_path()
+    if keep_labels and not use_cache:
+        raise click.BadParameter(
+            "les cartes d'étiquettes nécessitent le cache (--cache).",
+            param_hint="--cartes-etiquettes",
+        )
+    if memory == 0:
+        available = available_memory()
+        if available is None:
+            raise click.BadParameter(
+                "mémoire disponible inconnue, indiquez un budget en Mo.",
+                param_hint="--memoire",
+            )
+        memory = int(0.8 * available) // 2**20
+    try:
+        detect(dir, depths_list, csv, regex, config, proc, db_path, decoders,
+               threads, memory, thread_budget, image_timeout or None, index,
+               default_cache_path() if use_cache else None,
+               labels_dir,
+               retry_quarantined)
+    except RuntimeError as error:
+        # the results found so far are saved, see `detect`
+        raise click.ClickException(str(error))
@@ -0,0 +1,51 @@
+# Python standard library
+from pathlib import Path
+
+# Other dependancies
+import click
+from click import argument, command, option
+
+# Project files
+from spot_detector.core import tune_config_file
+from spot_detector.result_cache import default_labels_path
+
+
+@command()
+@argument(
+    "path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+)
+@option(
+    "-i",
+    "--image",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    help="L'image sur laquelle régler la détection. Par défaut, l'image de "
+    "référence de la palette.",
+)
+@option(
+    "--dossier-etiquettes",
+    "labels_dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
+    default=None,
+    help="Le dossier des cartes d'étiquettes du détecteur, s'il a été choisi "
+    "avec la même option. Par défaut, dans le cache de l'utilisateur.",
+)
+def param_tuner(path, image, labels_dir):
+    """
+    Règle les paramètres de détection de chaque couleur sur une image, en
+    affichant les taches trouvées à chaque modification. L'image n'est
+    étiquetée qu'une fois ; si le détecteur a gardé sa carte d'étiquettes
+    (option `--cartes-etiquettes`), elle n'est pas étiquetée du tout.
+
+    Touches : `a` / `e` couleur précédente / suivante, espace pour l'image en
+    niveaux de gris de la couleur, `_` pour enregistrer et quitter, échap pour
+    quitter sans enregistrer. Déplacement : `z`, `q`, `s`, `d`, zoom : `i`,
+    `o`, `p`.
+    """
+    if labels_dir is None:
+        labels_dir = default_labels_path()
+    tune_config_file(
+        Path(path),
+        None if image is None else Path(image),
+        labels_dir if labels_dir.is_dir() else None,
+    )
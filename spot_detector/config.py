@@ -1,11 +1,14 @@
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Literal, Optional
 from typing_extensions import Self
+import hashlib
 import json
 from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
 from pydantic_core.core_schema import FieldValidationInfo
 import cv2 as cv
 
+from .types import ColorTable
+
 
 class ColorData(BaseModel):
     """
@@ -60,10 +63,16 @@ class ColorData(BaseModel):
 
 
 class Threshold(BaseModel):
+    """
+    The thresholds of SimpleBlobDetector. With `shade_aware`, the schedule
+    is then reduced to one threshold per distinct binarization of the gray
+    levels of the color (see `detection.shade_aware_params`).
+    """
     automatic: bool
     mini: int = Field(ge=0, le=255, default=0)
     maxi: int = Field(ge=0, le=255, default=255)
     step: int = Field(ge=0, le=255, default=16)
+    shade_aware: bool = False
 
     @field_validator("maxi")
     def maxi_greater_than_mini(cls, maxi: int, info: FieldValidationInfo) -> int:
@@ -96,9 +105,14 @@ class DetParams(BaseModel):
     """
     The settings of openCV's SimpleBlobDetector, wrapped in
     an object for validation and serialization.
+    `engine` selects how the spots are counted:
+    `blob`: SimpleBlobDetector on the grayscale image of the color
+    `components`: connected components of the category mask of the color,
+                  with the same filters (see `detection.detect_components`)
     """
     color_name: str  
     thresh: Threshold
+    engine: Literal["blob", "components"] = "blob"
     min_dist: Optional[float] = Field(gt=0, default=None)
     filter_by_color: Optional[int] = Field(ge=0, le=255, default=255)
     area: Optional[SimpleParam] = None
@@ -183,10 +197,52 @@ class DetParams(BaseModel):
         return params
 
 
+class LabelingParams(BaseModel):
+    """
+    The choice of the function that gives to each pixel the label of the
+    nearest shade of the palette. All engines give the same labels, except
+    `lut` below 8 bits.
+    `plain`, `faster`, `ludicrous`: the older engines (`label_img`,
+           `label_img_faster`, `label_img_ludicrous`)
+    `fastest`: distance from every pixel to every shade (`label_img_fastest`)
+    `lut`: lookup table over the BGR cube quantized to `lut_bits` bits per
+           channel, built once per configuration (`label_img_lut`)
+    `tiled`: same as `fastest`, by bands of rows whose temporaries fit in
+             `budget_mb` MiB per worker (`label_img_tiled`)
+    `blas`: squared distance expanded as ‖p‖² − 2p·c + ‖c‖², whose cross
+            term is a single matrix product (`label_img_blas`)
+    """
+    engine: Literal[
+        "plain", "faster", "fastest", "ludicrous", "lut", "tiled", "blas"
+    ] = "fastest"
+    lut_bits: int = Field(ge=1, le=8, default=6)
+    budget_mb: int = Field(gt=0, default=256)
+
+
+class CropParams(BaseModel):
+    """
+    How the Petri dish is found before labeling.
+    `sweep`: Hough transforms on the full resolution image
+    `pyramid`: Hough transforms on a downsampled image, refined at full
+               resolution (see `transformations.find_main_circle`)
+    `reuse_geometry`: find the dish once per sub-directory and reuse it for
+                      the other depths while it still matches their edges.
+                      A worker then processes a whole sub-directory.
+    `fast_dog`: approximate the full resolution difference of gaussians of
+                `sweep` on a decimated image
+                (see `transformations.diff_of_gaussian_fast`)
+    """
+    mode: Literal["sweep", "pyramid"] = "sweep"
+    reuse_geometry: bool = False
+    fast_dog: bool = False
+
+
 class ColorAndParams(BaseModel):
     reference_image: str
     color_data: ColorData
     det_params: list[DetParams]
+    labeling: LabelingParams = Field(default_factory=LabelingParams)
+    crop: CropParams = Field(default_factory=CropParams)
 
     @classmethod
     def from_defaults(cls) -> Self:
@@ -203,6 +259,45 @@ class ColorAndParams(BaseModel):
             content = cls(**json_dict)
         return content
 
+    def fingerprint(self) -> str:
+        """
+        A hash of the settings that change the counts, see
+        `palette_fingerprint` and `color_fingerprints`.
+        """
+        parts = [self.palette_fingerprint(), *self.color_fingerprints()]
+        return hashlib.sha256(" ".join(parts).encode()).hexdigest()
+
+    def palette_fingerprint(self) -> str:
+        """
+        A hash of the settings that change the cropped label map of an
+        image: the color table and how the dish is found. The labeling
+        engine is left out, except for a `lut` engine below 8 bits, the only
+        one whose labels differ (see `LabelingParams`).
+        """
+        fields: dict[str, Any] = {
+            "table": self.color_data.table,
+            "crop": self.crop.model_dump(),
+        }
+        if self.labeling.engine == "lut" and self.labeling.lut_bits < 8:
+            fields["lut_bits"] = self.labeling.lut_bits
+        return json_hash(fields)
+
+    def color_fingerprints(self) -> list[str]:
+        """
+        For every color, a hash of the settings that change its count once
+        the image is labeled: its index in the palette and its detection
+        settings, but not its name.
+        """
+        return [
+            json_hash([i, params.model_dump(exclude={"color_name"})])
+            for i, params in enumerate(self.det_params)
+        ]
+
+
+def json_hash(content: Any) -> str:
+    encoded = json.dumps(content, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
 
 class CLIDefaults(BaseModel):
     image_dir: Optional[str] = None
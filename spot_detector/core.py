@@ -1,8 +1,9 @@
 # Python standard library
-import time
-from multiprocessing import Process, Queue
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from pathlib import Path
 import json
+import time
 
 # Other
 import cv2 as cv
@@ -12,12 +13,26 @@ from click import FileError, echo
 
 # Project files
 from .config import ColorAndParams, DetParams
-from .file_utils import (fetch_csv, read_csv, sorted_sub_dirs,
-                         unprocessed_images, write_csv)
+from .file_utils import (ImageIndex, append_to_journal, checkpoint,
+                         fetch_csv, fill_data_points, image_pixels,
+                         journal_path, load_results, manifest_path,
+                         open_journal, quarantine_path, read_csv,
+                         read_durations, read_quarantine, unprocessed_images,
+                         write_durations, write_quarantine)
+from .memory import MemoryBudget
 from .palette_gui import run_gui
-from .process_chains import init_workers
-from .transformations import get_k_means, label_img_fastest
-from .types import DataElement, DataRow, DataTable
+from .process_chains import (DetectionPlan, DishGeometry, ThreadWorkerPool,
+                             WorkerPool, get_labeler, threshold_savings)
+from .result_cache import LabelCache, ResultCache, file_hash
+from .results_store import ResultStore
+from .thread_budget import cpu_count, split_threads
+from .transformations import get_k_means
+from .tuning_gui import run_tuning_gui
+from .types import DataElement, DataTable, FolderJob, ImageElement, ImageHint
+
+# seconds between two rewrites of the csv file, results are journaled between
+CHECKPOINT_INTERVAL = 60.0
+HEADER_THREADS = 8  # image headers read at the same time, see longest_first
 
 
 def count_categories(categories: list[int]) -> int:
@@ -25,45 +40,6 @@ def count_categories(categories: list[int]) -> int:
     return len(list(filter(lambda x: x > 0, unique_categories)))
 
 
-def fill_data_points(
-    table: DataTable,
-    data_points: DataElement,
-    depth_count: int,
-    color_count: int,
-) -> None:
-    row, col, values = data_points
-    for i, value in enumerate(values):
-        table[row][1 + col + i * depth_count] = value
-    table[row][1 + col + len(values) * depth_count] = sum(values)
-    # Fill part1
-    try_line_completion(table[row], depth_count, color_count)
-
-
-def try_line_completion(
-    current_row: DataRow,
-    depth_count: int,
-    color_count: int,
-) -> None:
-    if "" in current_row[1 : depth_count + 1]:
-        return
-    middle = 1 + (1 + color_count) * depth_count
-    for i in range(color_count + 1):
-        start = i * depth_count
-        stop = start + depth_count
-        part1 = current_row[1 + start : 1 + stop]
-        sum1 = sum(map(int, part1))
-        if sum1:
-            part2 = [100 * int(v) / sum1 for v in part1]
-        else:
-            part2 = [float("nan")] * len(part1)
-        current_row[middle + start : middle + stop] = part2
-
-
-def any_alive(worker_list: list[Process]) -> bool:
-    status_list = map(lambda x: x.is_alive(), worker_list)
-    return any(status_list)
-
-
 def detect(
     image_dir: str | Path,
     depths: list[str],
@@ -71,6 +47,16 @@ def detect(
     regex: str,
     config_path: str | Path,
     proc: int,
+    db_path: str | Path | None = None,
+    decoders: int = 0,
+    threads: bool = False,
+    memory_mb: int | None = None,
+    thread_budget: int | None = None,
+    image_timeout: float | None = None,
+    index: ImageIndex | None = None,
+    cache_path: str | Path | None = None,
+    labels_dir: str | Path | None = None,
+    retry_quarantined: bool = False,
 ) -> None:
     # TODO: if the csv file already exists, check for coherence between
     #       number of colors, depths and dimensions of the csv file
@@ -78,42 +64,193 @@ def detect(
     config: ColorAndParams = ColorAndParams.from_path(config_path)
     colors = config.color_data.names
 
-    sub_dirs = sorted_sub_dirs(image_dir)
-    csv_file = fetch_csv(csv_path, depths, colors, sub_dirs)
-    images = unprocessed_images(sub_dirs, csv_file, depths, colors, regex)
+    if index is None:
+        index = ImageIndex(image_dir, regex, depths,
+                           manifest=manifest_path(csv_path))
+    csv_file = fetch_csv(csv_path, depths, colors, index.sub_dirs)
+    store = None
+    done = None
+    if db_path is None:
+        table = load_results(csv_file, depths, colors)
+    else:
+        store = ResultStore(db_path, depths, colors)
+        if store.imported():
+            table = read_csv(csv_file)  # only for the names of the folders
+        else:
+            # the csv file may hold results the database does not have yet
+            table = load_results(csv_file, depths, colors)
+            store.import_table(table)
+        done = store.processed()
+    images = unprocessed_images(index, csv_file, depths, colors, done, table)
+    # the images that made workers fail are left aside, unless retried
+    skipped: list[tuple[str, str]] = []
+    if not retry_quarantined:
+        quarantine = read_quarantine(csv_file)
+        skipped = [(img[2], quarantine[img[2]]) for img in images
+                   if img[2] in quarantine]
+        if skipped:
+            images = [img for img in images if img[2] not in quarantine]
+            print(f"{len(skipped)} images en quarantaine ignorées, voir "
+                  f"{quarantine_path(csv_file).name}.")
     remaining = len(images)
     print(f"{remaining} à traiter")
+    cache = None
+    cached: list[DataElement] = []
+    hints: dict[tuple[int, int], ImageHint] = {}
+    labels = None
+    if cache_path is not None:
+        cache = ResultCache(cache_path, config)
+        cached, hints = cache.lookup(images)
+        if cached:
+            print(f"{len(cached)} résultats repris du cache.")
+            known = {(row, col) for row, col, _ in cached}
+            images = [img for img in images if img[0:2] not in known]
+        if labels_dir is not None:
+            labels = LabelCache(labels_dir, config)
+    saved, total = threshold_savings(config)
+    if saved:
+        print(
+            f"Seuils adaptés aux nuances : {total - saved} binarisations"
+            f" par image au lieu de {total}."
+        )
 
-    in_queue, out_queue = Queue(), Queue()
-    for img in images:
-        in_queue.put(img)
-
-    workers = init_workers(proc, config, in_queue, out_queue)
-    for worker in workers:
-        in_queue.put("STOP")
-        worker.start()
-        time.sleep(2.5)
-        # Spread them in time to not use as much memory bandwidth
-    table = read_csv(csv_file)
-    while any_alive(workers) or not out_queue.empty():
-        if out_queue.empty():
-            time.sleep(1)
-            print(
-                f"{remaining} images restantes." " En attente de données.",
-                end="\r",
-            )
-        else:
-            # put values in table
-            print(
-                f"{remaining} images restantes." " Écriture en cours...  ",
-                end="\r",
-            )
-            data_points: DataElement = out_queue.get()
-            fill_data_points(table, data_points, len(depths), len(colors))
-            write_csv(csv_file, table)
+    if config.crop.reuse_geometry:
+        jobs = group_by_folder(images)
+    else:
+        jobs = [[img] for img in images]
+    history = read_durations(csv_file)
+    jobs = longest_first(jobs, history)
+
+    journal = None
+    if store is None:
+        journal = open_journal(csv_file)
+    memory = None
+    if memory_mb is not None:
+        memory = MemoryBudget(memory_mb * 2**20, config)
+    if thread_budget is not None:
+        proc, _ = split_threads(thread_budget, proc)
+    elif proc <= 0:
+        proc = cpu_count()  # the threads of the libraries are left as they are
+    if threads:
+        pool = ThreadWorkerPool(proc, config, memory, thread_budget, labels)
+    else:
+        pool = WorkerPool(proc, config, decoders=decoders, memory=memory,
+                          thread_budget=thread_budget,
+                          image_timeout=image_timeout, labels=labels)
+    last_checkpoint = time.monotonic()
+    try:
+        for data_points in chain(cached, pool.run(jobs, hints)):
+            row, col, values = data_points
+            if cache is not None and (row, col) in hints:
+                cache.add(hints[(row, col)][0], values)
+            if store is None:
+                append_to_journal(journal, table, data_points, depths)
+                fill_data_points(table, data_points, len(depths), len(colors))
+            else:
+                store.add(table[row][0], depths[col], values)
             remaining -= 1
-    in_queue.close()
-    out_queue.close()
+            print(f"{remaining} images restantes.  ", end="\r")
+            if time.monotonic() - last_checkpoint > CHECKPOINT_INTERVAL:
+                save_results(csv_file, table, store)
+                last_checkpoint = time.monotonic()
+    finally:
+        save_results(csv_file, table, store)
+        if store is None:
+            journal.close()
+            journal_path(csv_file).unlink(missing_ok=True)
+        else:
+            store.close()
+        if cache is not None:
+            cache.close()
+        print()
+        if pool.durations:
+            write_durations(csv_file,
+                            folder_durations(table, pool.durations, history))
+        path = write_quarantine(csv_file, skipped + pool.quarantined)
+        if pool.quarantined:
+            print(f"{len(pool.quarantined)} images mises en quarantaine, "
+                  f"voir {path.name}.")
+
+
+def save_results(
+    csv_file: Path,
+    table: DataTable,
+    store: ResultStore | None,
+) -> None:
+    """
+    Writes the csv file, from the table and its journal, or exported from
+    the database.
+    """
+    if store is None:
+        checkpoint(csv_file, table)
+    else:
+        store.export_csv(csv_file, [str(row[0]) for row in table[2:]])
+
+
+def group_by_folder(images: list[ImageElement]) -> list[FolderJob]:
+    """
+    Groups the images of the same sub-directory (same row), keeping the
+    order in which they were given.
+    """
+    folders: dict[int, FolderJob] = {}
+    for img in images:
+        folders.setdefault(img[0], []).append(img)
+    return list(folders.values())
+
+
+def longest_first(
+    jobs: list[FolderJob],
+    history: dict[str, float] | None = None,
+) -> list[FolderJob]:
+    """
+    Sorts the jobs by decreasing cost, so that the longest ones are not left
+    for the end, with a single worker busy while the others wait. Jobs of
+    the same cost keep their order.
+    An image costs the mean duration of the images of its sub-directory in
+    the previous runs, if any (see `file_utils.read_durations`): that is
+    what tells apart the sub-directories whose dish is hard to find. The
+    others are estimated from their number of pixels, read in the headers
+    of the images, at the speed measured on the known ones. Without any
+    history, a campaign whose images all have the same size keeps its order.
+    """
+    history = history or {}
+    images = [(i, path) for i, folder_job in enumerate(jobs)
+              for _, _, path in folder_job]
+    costs = [0.0] * len(jobs)
+    if all(Path(path).parent.name in history for _, path in images):
+        for i, path in images:
+            costs[i] += history[Path(path).parent.name]
+    else:
+        with ThreadPoolExecutor(HEADER_THREADS) as executor:
+            pixels = list(executor.map(image_pixels,
+                                       [path for _, path in images]))
+        known_time = 0.0
+        known_pixels = 0
+        for (_, path), count in zip(images, pixels):
+            if Path(path).parent.name in history:
+                known_time += history[Path(path).parent.name]
+                known_pixels += count
+        speed = known_time / known_pixels if known_time and known_pixels else 1.0
+        for (i, path), count in zip(images, pixels):
+            costs[i] += history.get(Path(path).parent.name, count * speed)
+    order = sorted(range(len(jobs)), key=costs.__getitem__, reverse=True)
+    return [jobs[i] for i in order]
+
+
+def folder_durations(
+    table: DataTable,
+    durations: dict[tuple[int, int], float],
+    history: dict[str, float],
+) -> dict[str, float]:
+    """
+    The history of the durations, updated with the mean duration of the
+    images processed in each sub-directory, from the `durations` of a pool.
+    """
+    folders: dict[str, list[float]] = {}
+    for (row, _), seconds in durations.items():
+        folders.setdefault(str(table[row][0]), []).append(seconds)
+    return history | {name: sum(values) / len(values)
+                      for name, values in folders.items()}
 
 
 def edit_config_file(k: int, path: Path, from_image: Path | None):
@@ -126,7 +263,7 @@ def edit_config_file(k: int, path: Path, from_image: Path | None):
         color_table = np.array(config_table, dtype=np.uint8)
         palette = color_table[:, 0:3]
         img = cv.imread(config.reference_image)
-        labeled_img = label_img_fastest(img, color_table)
+        labeled_img = get_labeler(color_table, config.labeling)(img)
     else:
         if k == 1:
             k = len(config_table)
@@ -167,3 +304,49 @@ def edit_config_file(k: int, path: Path, from_image: Path | None):
     with open(path, "w") as file:
         json.dump(config.model_dump(), file)
     print("Done !")
+
+
+def tune_config_file(
+    path: Path,
+    image: Path | None,
+    labels_dir: Path | None = None,
+) -> None:
+    """
+    Tunes the detection settings of the configuration on a single image,
+    the reference image by default, see `run_tuning_gui`. The image is
+    cropped and labeled once, or its label map is read from `labels_dir`
+    when the detector already kept it there.
+    """
+    config = ColorAndParams.from_path(path)
+    image_path = Path(config.reference_image if image is None else image)
+    plan = DetectionPlan.from_config(config)
+    labels = None
+    image_hash = None
+    labeled = None
+    if labels_dir is not None:
+        labels = LabelCache(labels_dir, config)
+        try:
+            image_hash = file_hash(image_path)
+        except OSError:
+            raise FileError(str(image_path), "Image could not be opened")
+        labeled = labels.load(image_hash)
+    if labeled is None:
+        img = cv.imread(str(image_path))
+        if img is None:
+            raise FileError(str(image_path), "Image could not be opened")
+        echo("recherche de la boîte et étiquetage de l'image")
+        locate = DishGeometry(config.crop.mode, config.crop.fast_dog).locate
+        _, labeled = plan.label(img, locate)
+        del img
+        if labels is not None:
+            labels.save(image_hash, labeled)
+    palette = np.array(config.color_data.table, dtype=np.uint8)[:, 0:3]
+    echo("running gui")
+    det_params = run_tuning_gui(plan, labeled, palette, config.color_data.names)
+    if det_params is None:
+        print("Abandon, la configuration n'a pas été modifiée.")
+        return
+    config.det_params = det_params
+    with open(path, "w") as file:
+        json.dump(config.model_dump(), file)
+    print("Done !")
@@ -0,0 +1,220 @@
+# Python standard library
+from collections import Counter
+from math import pi, sqrt
+
+# Other
+import cv2 as cv
+import numpy as np
+from numpy.typing import NDArray
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+BlobParams = cv.SimpleBlobDetector.Params
+
+
+def detect_components(mask: NDArray, params: BlobParams) -> list[cv.KeyPoint]:
+    """
+    Finds the spots of a binary category mask with a single pass of
+    connected component analysis, instead of the many binarizations of
+    cv.SimpleBlobDetector. The filters are read from the same
+    `SimpleBlobDetector.Params` as the blob detector (see
+    `DetParams.load_params`) and computed the same way, from the moments,
+    perimeter and convex hull of the outer contour of each component.
+    Components whose centers are closer than `minDistBetweenBlobs` are
+    merged into a single spot.
+    :param mask: uint8 ndarray of shape (Y, X), 255 on the color, 0 elsewhere.
+    :param params: the settings of the blob detector for this color.
+    :return: one key point per spot.
+    """
+    contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+    centers = []
+    radii = []
+    for contour in contours:
+        moms = cv.moments(contour)
+        area = moms["m00"]
+        if not passes_shape_filters(contour, moms, params):
+            continue
+        if area == 0.0:
+            continue
+        x = moms["m10"] / area
+        y = moms["m01"] / area
+        if params.filterByColor:
+            if mask[round(y), round(x)] != params.blobColor:
+                continue
+        centers.append((x, y))
+        radii.append(sqrt(area / pi))
+    return merge_close_centers(centers, radii, params.minDistBetweenBlobs)
+
+
+def passes_shape_filters(
+    contour: NDArray,
+    moms: dict[str, float],
+    params: BlobParams,
+) -> bool:
+    """
+    The area, circularity, inertia and convexity filters of
+    cv.SimpleBlobDetector, in the same order and with the same bounds:
+    a value is rejected if it is lower than the minimum, or greater than or
+    equal to the maximum.
+    """
+    area = moms["m00"]
+    if params.filterByArea:
+        if area < params.minArea or area >= params.maxArea:
+            return False
+    if params.filterByCircularity:
+        perimeter = cv.arcLength(contour, True)
+        if perimeter == 0.0:
+            return False
+        ratio = 4 * pi * area / (perimeter * perimeter)
+        if ratio < params.minCircularity or ratio >= params.maxCircularity:
+            return False
+    if params.filterByInertia:
+        ratio = inertia_ratio(moms)
+        if ratio < params.minInertiaRatio or ratio >= params.maxInertiaRatio:
+            return False
+    if params.filterByConvexity:
+        hull_area = cv.contourArea(cv.convexHull(contour))
+        if hull_area == 0.0:
+            return False
+        ratio = cv.contourArea(contour) / hull_area
+        if ratio < params.minConvexity or ratio >= params.maxConvexity:
+            return False
+    return True
+
+
+def inertia_ratio(moms: dict[str, float]) -> float:
+    mu20, mu02, mu11 = moms["mu20"], moms["mu02"], moms["mu11"]
+    denominator = sqrt((2 * mu11) ** 2 + (mu20 - mu02) ** 2)
+    if denominator <= 1e-2:
+        return 1.0
+    cos_min = (mu20 - mu02) / denominator
+    sin_min = 2 * mu11 / denominator
+    i_min = 0.5 * (mu20 + mu02) - 0.5 * (mu20 - mu02) * cos_min - mu11 * sin_min
+    i_max = 0.5 * (mu20 + mu02) + 0.5 * (mu20 - mu02) * cos_min + mu11 * sin_min
+    return i_min / i_max
+
+
+def merge_close_centers(
+    centers: list[tuple[float, float]],
+    radii: list[float],
+    min_dist: float,
+) -> list[cv.KeyPoint]:
+    """
+    Groups the centers closer than `min_dist` to one another and returns one
+    key point per group, at the center of its largest component.
+    """
+    if len(centers) == 0:
+        return []
+    points = np.array(centers)
+    count = len(centers)
+    pairs = cKDTree(points).query_pairs(min_dist, output_type="ndarray")
+    graph = coo_matrix(
+        (np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(count, count)
+    )
+    _, groups = connected_components(graph, directed=False)
+    largest: dict[int, int] = {}
+    for i, group in enumerate(groups):
+        if group not in largest or radii[i] > radii[largest[group]]:
+            largest[group] = i
+    return [
+        cv.KeyPoint(float(points[i, 0]), float(points[i, 1]), 2 * radii[i])
+        for i in largest.values()
+    ]
+
+
+def engine_agreement(
+    gs_img: NDArray,
+    mask: NDArray,
+    params: BlobParams,
+) -> tuple[int, int]:
+    """
+    Counts the spots of one color with both detection engines.
+    :param gs_img: the grayscale image of the color, for the blob detector.
+    :param mask: the category mask of the color, for `detect_components`.
+    :param params: the settings of the blob detector for this color.
+    :return: the blob detector count and the connected components count.
+    """
+    blob_count = len(cv.SimpleBlobDetector.create(params).detect(gs_img))
+    component_count = len(detect_components(mask, params))
+    return blob_count, component_count
+
+
+def blob_thresholds(params: BlobParams) -> list[float]:
+    """
+    The thresholds at which cv.SimpleBlobDetector binarizes the image, in
+    the same order and with the same float accumulation.
+    """
+    if params.thresholdStep <= 0:
+        return [params.minThreshold]
+    thresholds = []
+    thresh = params.minThreshold
+    while thresh < params.maxThreshold:
+        thresholds.append(thresh)
+        thresh += params.thresholdStep
+    return thresholds
+
+
+def shade_aware_params(
+    params: BlobParams,
+    levels: NDArray,
+) -> tuple[BlobParams, int]:
+    """
+    Shrinks the threshold schedule of the blob detector to one threshold per
+    distinct binarization of the grayscale image of a color, whose only gray
+    levels are `levels`. A threshold t keeps the pixels brighter than t, so
+    every threshold between the same two consecutive levels gives the same
+    mask: the detector sees the same blobs again and again.
+    The new schedule hits every mask that the original one hits, once, with
+    a minimal repeatability of 1. This is only done when every one of these
+    masks was hit at least `minRepeatability` times, so that each blob
+    passed the repeatability test anyway. Otherwise, `params` is kept.
+    :param params: the settings of the blob detector for this color.
+    :param levels: the gray levels that the image of this color can take.
+    :return: the new settings and the number of binarizations saved per
+    image.
+    """
+    levels = np.unique(levels).astype(np.float64)
+    thresholds = blob_thresholds(params)
+    masks = [mask_index(levels, t) for t in thresholds]
+    hits = Counter(mask for mask in masks if mask > 0)
+    if not hits or min(hits.values()) < params.minRepeatability:
+        return params, 0
+    # the interval [low, high) of thresholds giving each mask, in order
+    intervals = [
+        (levels[-mask - 1], levels[-mask])
+        for mask in sorted(hits, reverse=True)
+    ]
+    if len(intervals) == 1:
+        start, step = (intervals[0][0] + intervals[0][1]) / 2, 1.0
+    else:
+        start = (intervals[0][0] + intervals[0][1]) / 2
+        stop = (intervals[-1][0] + intervals[-1][1]) / 2
+        step = (stop - start) / (len(intervals) - 1)
+    new_params = copy_params(params)
+    new_params.minThreshold = float(start)
+    new_params.maxThreshold = float(start + step * (len(intervals) - 0.5))
+    new_params.thresholdStep = float(step)
+    new_params.minRepeatability = 1
+    new_thresholds = blob_thresholds(new_params)
+    new_masks = [mask_index(levels, t) for t in new_thresholds]
+    if sorted(new_masks) != sorted(hits):
+        # the masks can not be reached with a regular step
+        return params, 0
+    return new_params, len(thresholds) - len(new_thresholds)
+
+
+def mask_index(levels: NDArray, thresh: float) -> int:
+    """
+    Identifies the mask given by a threshold: the number of levels that are
+    kept, from the brightest one.
+    """
+    return int(np.count_nonzero(levels > thresh))
+
+
+def copy_params(params: BlobParams) -> BlobParams:
+    new_params = cv.SimpleBlobDetector.Params()
+    for name in dir(params):
+        if not name.startswith("_"):
+            setattr(new_params, name, getattr(params, name))
+    return new_params
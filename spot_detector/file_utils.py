@@ -1,16 +1,21 @@
 # Python standard library
 import csv
+import json
+import os
 import re
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os import mkdir
 from pathlib import Path
+from typing import TextIO
 
 # Other dependancies
 import numpy as np
 from click import FileError, confirm
 
 # Project Files
-from .types import DataRow, DataTable, ImageElement
+from .types import DataElement, DataRow, DataTable, ImageElement
 
 img_file_name_pattern = re.compile(r".+\.(jpe?g|JPE?G|png|PNG|tiff|TIFF)")
 
@@ -41,9 +46,212 @@ def write_csv(
               enregistrées dans le fichier csv.
       `return`: Rien.
     """
-    with open(Path(csv_file), "w", newline="") as file:
+    # Written next to the file then renamed, so that the csv file is never
+    # half-written, even if the process is killed.
+    path = Path(csv_file)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", newline="") as file:
         writer = csv.writer(file)
         writer.writerows(table)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def journal_path(csv_file: str | Path) -> Path:
+    """
+    Le chemin du journal des résultats associé au fichier csv `csv_file` :
+    le même nom, suivi de `.journal`.
+    """
+    path = Path(csv_file)
+    return path.with_name(f"{path.name}.journal")
+
+
+def quarantine_path(csv_file: str | Path) -> Path:
+    """
+    Le chemin de la liste des images mises en quarantaine associée au
+    fichier csv `csv_file` : le même nom, suivi de `.quarantaine`.
+    """
+    path = Path(csv_file)
+    return path.with_name(f"{path.name}.quarantaine")
+
+
+def read_quarantine(csv_file: str | Path) -> dict[str, str]:
+    """
+    Lit les images mises en quarantaine lors des traitements précédents de
+    `csv_file`, voir `write_quarantine`.
+    `return`: La raison de la mise en quarantaine de chaque image, par
+            chemin. Vide s'il n'y en a aucune.
+    """
+    quarantined = {}
+    try:
+        with open(quarantine_path(csv_file), "r") as file:
+            for line in file:
+                image, _, reason = line.rstrip("\n").partition("\t")
+                if image:
+                    quarantined[image] = reason
+    except FileNotFoundError:
+        pass
+    return quarantined
+
+
+def write_quarantine(
+    csv_file: str | Path,
+    images: list[tuple[str, str]],
+) -> Path:
+    """
+    Écrit les images mises en quarantaine, une par ligne avec la raison
+    séparée par une tabulation, dans un fichier au nom de `csv_file` suivi de
+    `.quarantaine`. Elles ne sont plus traitées aux lancements suivants, sauf
+    avec l'option `--reessayer-quarantaine`. Le fichier est supprimé s'il n'y
+    en a aucune.
+    `return`: Le chemin du fichier.
+    """
+    path = quarantine_path(csv_file)
+    if not images:
+        path.unlink(missing_ok=True)
+        return path
+    with open(path, "w") as file:
+        for image, reason in images:
+            file.write(f"{image}\t{reason}\n")
+    return path
+
+
+def open_journal(csv_file: str | Path) -> TextIO:
+    """
+    Ouvre le journal associé à `csv_file` en mode "a". Si sa dernière ligne
+    est incomplète, le processus ayant été interrompu pendant son écriture,
+    elle est terminée, pour que le prochain résultat ne lui soit pas collé.
+    `return`: Le fichier du journal, à passer à `append_to_journal`.
+    """
+    path = journal_path(csv_file)
+    broken = False
+    try:
+        with open(path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            broken = file.read(1) != b"\n"
+    except OSError:
+        pass  # no journal yet, or an empty one
+    journal = open(path, "a", newline="")
+    if broken:
+        journal.write("\n")
+        journal.flush()
+    return journal
+
+
+def append_to_journal(
+    journal: TextIO,
+    table: DataTable,
+    data_points: DataElement,
+    depths: list[str],
+) -> None:
+    """
+    Ajoute le résultat d'une image à la fin du journal, sur une seule ligne :
+    nom du dossier, profondeur, puis le nombre de points de chaque couleur.
+        `journal`: Le fichier du journal, ouvert en mode "a".
+          `table`: La table du fichier csv, pour le nom du dossier.
+    `data_points`: Le résultat (ligne, colonne, valeurs).
+         `depths`: Les différentes profondeurs traitées dans le csv.
+    """
+    row, col, values = data_points
+    line = [table[row][0], depths[col]] + [str(int(v)) for v in values]
+    # the same quoting as `replay_journal`, a folder name may hold a comma
+    csv.writer(journal, lineterminator="\n").writerow(line)
+    journal.flush()
+
+
+def replay_journal(
+    csv_file: str | Path,
+    table: DataTable,
+    depths: list[str],
+    colors: list[str],
+) -> int:
+    """
+    Remplit `table` avec les résultats du journal associé à `csv_file`, s'il
+    existe. Une dernière ligne incomplète, écrite au moment où le processus a
+    été interrompu, est ignorée.
+    `return`: Le nombre de résultats rejoués.
+    """
+    path = journal_path(csv_file)
+    if not path.is_file():
+        return 0
+    fname_2_row = map_folder_to_row(table)
+    depth_2_col = {depth: i for i, depth in enumerate(depths)}
+    count = 0
+    with open(path, "r", newline="") as file:
+        for line in csv.reader(file):
+            if len(line) != 2 + len(colors):
+                continue
+            folder, depth, *counts = line
+            if folder not in fname_2_row or depth not in depth_2_col:
+                continue
+            try:
+                values = [int(v) for v in counts]
+            except ValueError:
+                continue
+            data_points = (fname_2_row[folder], depth_2_col[depth], values)
+            fill_data_points(table, data_points, len(depths), len(colors))
+            count += 1
+    return count
+
+
+def load_results(
+    csv_file: str | Path,
+    depths: list[str],
+    colors: list[str],
+) -> DataTable:
+    """
+    Lit le fichier csv `csv_file` et y ajoute les résultats de son journal.
+    """
+    table = read_csv(csv_file)
+    replay_journal(csv_file, table, depths, colors)
+    return table
+
+
+def checkpoint(csv_file: str | Path, table: DataTable) -> None:
+    """
+    Enregistre `table` dans le fichier csv, puis vide le journal dont les
+    résultats y sont maintenant inscrits.
+    """
+    write_csv(csv_file, table)
+    path = journal_path(csv_file)
+    if path.is_file():
+        with open(path, "w"):
+            pass
+
+
+def fill_data_points(
+    table: DataTable,
+    data_points: DataElement,
+    depth_count: int,
+    color_count: int,
+) -> None:
+    row, col, values = data_points
+    for i, value in enumerate(values):
+        table[row][1 + col + i * depth_count] = value
+    table[row][1 + col + len(values) * depth_count] = sum(values)
+    # Fill part1
+    try_line_completion(table[row], depth_count, color_count)
+
+
+def try_line_completion(
+    current_row: DataRow,
+    depth_count: int,
+    color_count: int,
+) -> None:
+    if "" in current_row[1 : depth_count + 1]:
+        return
+    middle = 1 + (1 + color_count) * depth_count
+    for i in range(color_count + 1):
+        start = i * depth_count
+        stop = start + depth_count
+        part1 = current_row[1 + start : 1 + stop]
+        sum1 = sum(map(int, part1))
+        if sum1:
+            part2 = [100 * int(v) / sum1 for v in part1]
+        else:
+            part2 = [float("nan")] * len(part1)
+        current_row[middle + start : middle + stop] = part2
 
 
 def is_valid_csv(
@@ -94,7 +302,8 @@ def fetch_csv(
                 f"Les dimensions du fichier {path_obj.name} "
                 "ne correspondent pas aux paramètres fournis"
             )
-    # otherwise, create a new csv file
+    # otherwise, create a new csv file, without the results of an older one
+    journal_path(path_obj).unlink(missing_ok=True)
     label_row_1, label_row_2 = first_two_rows(depths, colors)
     empty_part = [""] * (col_count - 1)
     rows = []
@@ -151,38 +360,44 @@ def map_folder_to_row(table: DataTable) -> dict[str, int]:
 
 
 def unprocessed_images(
-    sub_directories: list[Path],
+    index: "ImageIndex",
     csv_file: str | Path,
     depths: list[str],
     colors: list[str],
-    regex: str,
+    done: set[tuple[str, str]] | None = None,
+    table: DataTable | None = None,
 ) -> list[ImageElement]:
     """
-    Donne les images présentes dans les différents dossiers `sub_directories`
+    Donne les images présentes dans les différents sous-dossiers de `index`
     qui n'ont pas été traitées et dont les valeurs ne sont pas indiquées dans
-    le fichier `csv_file`.
+    le fichier `csv_file`, ou dans `done` s'il est donné.
 
-    `sub_directories`: Les différents dossiers en question.
+              `index`: Les images des sous-dossiers, voir `ImageIndex`.
            `csv_file`: Le fichier où sont renseignées les valeurs
                      des images traitées.
              `depths`: Les différentes profondeurs traitées dans le csv.
              `colors`: Les différentes couleurs traitées dans le csv.
-              `regex`: L'expression régulière qui permet d'identifier
-                     précisément le nom d'un fichier d'image, avec la valeur
-                     de profondeur remplacée par $value.
+               `done`: Les couples (dossier, profondeur) des images déjà
+                     traitées, par exemple `ResultStore.processed()`.
+              `table`: La table de `csv_file` si elle est déjà lue, avec
+                     son journal si `done` n'est pas donné.
              `return`: Les images non-traitées, sous la forme d'une liste
                      d'ImageElement. C'est-à-dire, un tuple
                      (ligne, colonne, chemin).
     """
-    table = read_csv(csv_file)
+    if table is None and done is None:
+        table = load_results(csv_file, depths, colors)
+    elif table is None:
+        table = read_csv(csv_file)
     unprocessed = []
     fname_2_row = map_folder_to_row(table)
-    for sub_dir in sub_directories:
+    for sub_dir in index.sub_dirs:
         row_nbr = fname_2_row[sub_dir.name]
         for depth_nbr, depth in enumerate(depths):
-            matching_files = match_dir_items(sub_dir, regex, depth)
+            matching_files = index.images(sub_dir, depth)
             if len(matching_files) == 0:
                 print(f"No Match for depth = {depth} in directory {sub_dir.name}")
+                continue
             if len(matching_files) > 1:
                 print(
                     "Attention, plusieurs images correspondent à la même"
@@ -190,7 +405,11 @@ def unprocessed_images(
                 )
                 print([file.name for file in matching_files])
             img: ImageElement = (row_nbr, depth_nbr, str(matching_files[0]))
-            if is_img_processed(img, table, len(depths), len(colors)):
+            if done is not None:
+                processed = (sub_dir.name, depth) in done
+            else:
+                processed = is_img_processed(img, table, len(depths), len(colors))
+            if processed:
                 print(f"already processed: {img}")
                 continue
             else:
@@ -238,10 +457,208 @@ def sorted_sub_dirs(path: str | Path) -> list[Path]:
       `path`: un objet de chemin du dossier principal
     `return`: la liste triée des sous-dossiers qu'il contient
     """
-    subs = [e for e in Path(path).iterdir() if e.is_dir()]
+    with os.scandir(path) as entries:
+        subs = [Path(e.path) for e in entries if e.is_dir()]
     return sorted(subs)
 
 
+def depth_regex(pattern: str, depths: list[str]) -> re.Pattern:
+    """
+    Compile en une seule expression régulière le modèle de nom d'image
+    `pattern` pour toutes les profondeurs `depths` : $value y est remplacé
+    par le groupe `depth`, qui capture la profondeur de l'image.
+    `pattern`: L'expression régulière, avec $value à la place de la profondeur.
+     `depths`: Les différentes profondeurs.
+     `return`: L'expression compilée. Sans $value dans `pattern`, elle n'a pas
+             de groupe `depth`, et une image correspond à toutes les
+             profondeurs.
+    """
+    marker = "\x00"
+    parts = string.Template(pattern).substitute(value=marker).split(marker)
+    alternatives = "|".join(map(re.escape, depths))
+    combined = parts[0]
+    if len(parts) > 1:
+        combined += f"(?P<depth>{alternatives})" + parts[1]
+        combined += "".join("(?P=depth)" + part for part in parts[2:])
+    return re.compile(combined)
+
+
+def manifest_path(csv_file: str | Path) -> Path:
+    """
+    Le chemin du manifeste des images associé au fichier csv `csv_file` :
+    le même nom, suivi de `.manifeste`.
+    """
+    path = Path(csv_file)
+    return path.with_name(f"{path.name}.manifeste")
+
+
+def durations_path(csv_file: str | Path) -> Path:
+    """
+    Le chemin de l'historique des durées de traitement associé au fichier csv
+    `csv_file` : le même nom, suivi de `.durees`.
+    """
+    path = Path(csv_file)
+    return path.with_name(f"{path.name}.durees")
+
+
+def read_durations(csv_file: str | Path) -> dict[str, float]:
+    """
+    Lit l'historique des durées de traitement de `csv_file`, voir
+    `write_durations`.
+    `return`: La durée moyenne du traitement d'une image, en secondes, par
+            nom de sous-dossier. Vide s'il n'existe pas ou est illisible.
+    """
+    try:
+        with open(durations_path(csv_file), "r") as file:
+            content = json.load(file)
+        return {str(name): float(seconds) for name, seconds in content.items()}
+    except (OSError, ValueError, AttributeError, TypeError):
+        return {}
+
+
+def write_durations(csv_file: str | Path, durations: dict[str, float]) -> None:
+    """
+    Enregistre la durée moyenne du traitement d'une image de chaque
+    sous-dossier, pour ordonner les traitements suivants (voir
+    `core.longest_first`).
+    """
+    path = durations_path(csv_file)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(durations, file)
+    os.replace(tmp_path, path)
+
+
+# (mtime en ns, nombre d'images, {profondeur: [noms de fichiers]})
+FolderScan = tuple[int, int, dict[str, list[str]]]
+
+
+class ImageIndex:
+    """
+    Les images d'un dossier principal, lues en un seul passage sur chacun
+    de ses sous-dossiers, avec `os.scandir`, plutôt qu'une fois par
+    profondeur et une fois pour le nombre d'images. Les sous-dossiers sont
+    lus en parallèle, ce qui masque la latence d'un disque réseau.
+    Avec un manifeste, le résultat de la lecture de chaque sous-dossier est
+    enregistré avec sa date de modification : au lancement suivant, les
+    sous-dossiers qui n'ont pas été modifiés depuis ne sont pas relus.
+    """
+
+    # Un dossier modifié aussi récemment peut encore l'être sans que sa date
+    # ne change, si le système de fichiers n'est pas assez précis : il n'est
+    # pas enregistré dans le manifeste.
+    racy_delay: float = 2.0
+
+    def __init__(
+        self,
+        main_dir: str | Path,
+        regex: str,
+        depths: list[str],
+        threads: int = 8,
+        manifest: str | Path | None = None,
+    ) -> None:
+        """
+        `main_dir`: Le dossier principal, qui contient les sous-dossiers
+                  d'images.
+           `regex`: L'expression régulière des noms d'images, avec $value à
+                  la place de la profondeur.
+          `depths`: Les différentes profondeurs.
+         `threads`: Le nombre de sous-dossiers lus en même temps.
+        `manifest`: Le fichier du manifeste, aucun par défaut.
+        """
+        self.regex: str = regex
+        self.depths: list[str] = depths
+        self.pattern: re.Pattern = depth_regex(regex, depths)
+        self.manifest: Path | None = None
+        if manifest is not None:
+            self.manifest = Path(manifest)
+        self.known: dict[str, FolderScan] = self.read_manifest()
+        self.sub_dirs: list[Path] = sorted_sub_dirs(main_dir)
+        self.scans: dict[str, FolderScan] = {}
+        self.rescanned: int = 0
+        start = time.time_ns()
+        with ThreadPoolExecutor(max(1, threads)) as executor:
+            scans = executor.map(self.fetch, self.sub_dirs)
+            for sub_dir, scan in zip(self.sub_dirs, scans):
+                self.scans[sub_dir.name] = scan
+                if scan is not self.known.get(sub_dir.name):
+                    self.rescanned += 1
+        self.image_counts: dict[str, int] = {
+            name: count for name, (_, count, _) in self.scans.items()
+        }
+        if self.manifest is not None:
+            self.write_manifest(start - int(self.racy_delay * 1e9))
+
+    def read_manifest(self) -> dict[str, FolderScan]:
+        """
+        Les sous-dossiers du manifeste, s'il existe et s'il a été fait pour
+        la même expression régulière et les mêmes profondeurs.
+        """
+        if self.manifest is None or not self.manifest.is_file():
+            return {}
+        try:
+            with open(self.manifest, "r") as file:
+                content = json.load(file)
+            if (content["regex"], content["depths"]) != (self.regex, self.depths):
+                return {}
+            return {name: (mtime, count, matches) for name, (mtime, count,
+                    matches) in content["folders"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}  # illisible, tout est relu
+
+    def write_manifest(self, newest: int) -> None:
+        """
+        Enregistre le manifeste, sans les sous-dossiers modifiés après
+        `newest` (en ns).
+        """
+        content = {
+            "regex": self.regex,
+            "depths": self.depths,
+            "folders": {name: scan for name, scan in self.scans.items()
+                        if scan[0] <= newest},
+        }
+        tmp_path = self.manifest.with_name(f".{self.manifest.name}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(content, file)
+        os.replace(tmp_path, self.manifest)
+
+    def fetch(self, sub_dir: Path) -> FolderScan:
+        """
+        Le contenu du sous-dossier `sub_dir` : celui du manifeste s'il n'a
+        pas été modifié depuis, sinon celui d'une nouvelle lecture.
+        """
+        mtime = os.stat(sub_dir).st_mtime_ns
+        known = self.known.get(sub_dir.name)
+        if known is not None and known[0] == mtime:
+            return known
+        count, matches = self.scan(sub_dir)
+        return mtime, count, matches
+
+    def scan(self, sub_dir: Path) -> tuple[int, dict[str, list[str]]]:
+        """
+        Lit le sous-dossier `sub_dir`.
+        `return`: Le nombre d'images qu'il contient, et pour chaque
+                profondeur, le nom des fichiers qui correspondent.
+        """
+        count = 0
+        matches: dict[str, list[str]] = {}
+        with os.scandir(sub_dir) as entries:
+            for entry in entries:
+                if img_file_name_pattern.match(entry.name) and entry.is_file():
+                    count += 1
+                match = self.pattern.fullmatch(entry.name)
+                if match is None:
+                    continue
+                depth = match.groupdict().get("depth")
+                for key in self.depths if depth is None else [depth]:
+                    matches.setdefault(key, []).append(entry.name)
+        return count, matches
+
+    def images(self, sub_dir: Path, depth: str) -> list[Path]:
+        _, _, matches = self.scans[sub_dir.name]
+        return [sub_dir.joinpath(name) for name in matches.get(depth, [])]
+
+
 def incoherent_file(
     file_path: str | Path,
     should_exist: bool,
@@ -255,20 +672,72 @@ def is_im_file(obj: Path) -> bool:
     return bool(obj.is_file() and img_file_name_pattern.match(obj.name))
 
 
+# JPEG start of frame markers: every 0xC0 to 0xCF, except DHT, JPG and DAC
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def image_size(path: str | Path) -> tuple[int, int] | None:
+    """
+    Lit les dimensions d'une image JPEG ou PNG dans son en-tête, sans la
+    décoder.
+      `path`: Le chemin du fichier d'image.
+    `return`: (hauteur, largeur), ou None si le format n'est pas reconnu.
+    """
+    with open(path, "rb") as file:
+        head = file.read(24)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            width = int.from_bytes(head[16:20], "big")
+            height = int.from_bytes(head[20:24], "big")
+            return height, width
+        if head[:2] != b"\xff\xd8":
+            return None
+        file.seek(2)
+        while True:
+            marker = file.read(4)
+            if len(marker) < 4 or marker[0] != 0xFF:
+                return None
+            length = int.from_bytes(marker[2:4], "big")
+            if marker[1] in JPEG_SOF_MARKERS:
+                frame = file.read(5)
+                if len(frame) < 5:
+                    return None
+                height = int.from_bytes(frame[1:3], "big")
+                width = int.from_bytes(frame[3:5], "big")
+                return height, width
+            file.seek(length - 2, 1)
+
+
+def image_pixels(path: str | Path) -> int:
+    """
+    Estime le nombre de pixels d'une image sans la décoder : d'après son
+    en-tête pour les formats JPEG et PNG, sinon d'après la taille du fichier,
+    comme s'il s'agissait d'une image BGR non compressée (cas des TIFF).
+      `path`: Le chemin du fichier d'image.
+    `return`: Le nombre de pixels, 0 si le fichier ne peut être lu.
+    """
+    try:
+        size = image_size(path)
+        if size is None:
+            return os.path.getsize(path) // 3
+    except OSError:
+        return 0
+    return size[0] * size[1]
+
+
 def count_images(dir: Path) -> int:
     return sum(map(is_im_file, dir.iterdir()))
 
 
 def check_img_count(
     expected: int,
-    directories: list[Path],
+    index: ImageIndex,
 ) -> tuple[int, list[int]]:
     """
     Retourne le nombre de répertoires contenant le mauvais nombre d'images,
     et la liste du nombre d'images contenu pour chacun des répertoires, dans
-    l'ordre de la liste des entrées.
+    l'ordre de `index.sub_dirs`.
     """
-    image_counts = list(map(count_images, directories))
+    image_counts = [index.image_counts[d.name] for d in index.sub_dirs]
     mismatches = len(list(filter(lambda n_im: n_im != expected, image_counts)))
     return mismatches, image_counts
 
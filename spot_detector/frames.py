@@ -0,0 +1,85 @@
+# Python standard library
+from multiprocessing import Queue
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.synchronize import Event as EventType
+from queue import Empty
+
+# Other
+import numpy as np
+from numpy.typing import NDArray
+
+Frame = tuple[int, tuple[int, ...]]  # (slot, shape) of a decoded image
+
+
+class FrameRing:
+    """
+    A ring of fixed size slots in shared memory, in which the decoders write
+    the images and from which the workers read them, without copying them
+    from a process to another. The free slots go around in a queue: a
+    decoder takes one before decoding an image, the worker gives it back
+    once the image is processed. The parent process creates the ring, and
+    is the only one that unlinks it.
+    """
+
+    def __init__(self, slots: int, slot_size: int) -> None:
+        """
+        :param slots: The number of images that can be shared at once
+        :param slot_size: The size of a slot, in bytes
+        """
+        self.slots: int = slots
+        self.slot_size: int = slot_size
+        self.memory = SharedMemory(create=True, size=slots * slot_size)
+        self.free: Queue = Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def __getstate__(self) -> dict:
+        # the memory is attached again, by name, in the child process
+        state = self.__dict__.copy()
+        state["memory"] = self.memory.name
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.memory = SharedMemory(name=state["memory"])
+
+    def fits(self, shape: tuple[int, ...]) -> bool:
+        return int(np.prod(shape)) <= self.slot_size
+
+    def acquire(self, stop: EventType, timeout: float) -> int | None:
+        """
+        Waits for a free slot, or returns None once `stop` is set.
+        """
+        while not stop.is_set():
+            try:
+                return self.free.get(timeout=timeout)
+            except Empty:
+                continue
+        return None
+
+    def release(self, slot: int) -> None:
+        self.free.put(slot)
+
+    def view(self, frame: Frame) -> NDArray:
+        """
+        The uint8 image of a slot. It is only valid until the slot is
+        released.
+        """
+        slot, shape = frame
+        return np.ndarray(
+            shape, dtype=np.uint8, buffer=self.memory.buf,
+            offset=slot * self.slot_size,
+        )
+
+    def write(self, slot: int, img: NDArray) -> Frame:
+        frame = (slot, img.shape)
+        self.view(frame)[...] = img
+        return frame
+
+    def close(self) -> None:
+        self.memory.close()
+
+    def unlink(self) -> None:
+        self.memory.close()
+        self.memory.unlink()
+        self.free.close()
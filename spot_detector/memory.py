@@ -0,0 +1,141 @@
+# Python standard library
+from pathlib import Path
+
+# Project files
+from .config import ColorAndParams, LabelingParams
+from .file_utils import image_size
+from .types import FolderJob
+
+# Resident memory of an idle worker process: interpreter, NumPy, OpenCV and
+# the detection settings, measured on Linux.
+WORKER_OVERHEAD = 160 * 2**20
+# Bytes per pixel of the crop, for each way of finding the dish
+CROP_BYTES_PER_PIXEL = {"sweep": 9, "pyramid": 1}
+
+
+def labeler_bytes_per_pixel(settings: LabelingParams, shades: int) -> float:
+    """
+    The peak memory of each labeling engine per pixel of the image, for a
+    palette of `shades` colors. Measured on a 1.5 Mpx image with 10 and 40
+    shades, the relation is linear.
+    """
+    per_pixel = {
+        "plain": 88 + 8 * shades,
+        "faster": 44 * shades,
+        "fastest": 12 + 32 * shades,
+        "ludicrous": 56 + 8 * shades,
+        "lut": 8,
+        "tiled": 12 + 32 * shades,
+        "blas": 21 + 4 * shades,
+    }
+    return per_pixel[settings.engine]
+
+
+def image_peak_memory(shape: tuple[int, int], config: ColorAndParams) -> int:
+    """
+    Estimates the peak memory used by a worker to process an image, from its
+    resolution, the size of the palette and the selected engines. The whole
+    image is assumed to be in the dish, so it is an upper bound.
+    :param shape: (height, width) of the image
+    :param config: The configuration of the detector
+    :return: A number of bytes
+    """
+    pixels = shape[0] * shape[1]
+    shades = len(config.color_data.table)
+    colors = len(config.det_params)
+    labeling = labeler_bytes_per_pixel(config.labeling, shades) * pixels
+    if config.labeling.engine == "tiled":
+        labeling = min(labeling, config.labeling.budget_mb * 2**20)
+    # decoded image, crop, labels, gray images, and a binarized image
+    per_pixel = 3 + CROP_BYTES_PER_PIXEL[config.crop.mode] + 1 + colors + 2
+    if any(settings.engine == "components" for settings in config.det_params):
+        per_pixel += colors  # the masks
+    return int(per_pixel * pixels + labeling)
+
+
+def worker_overhead(config: ColorAndParams) -> int:
+    overhead = WORKER_OVERHEAD
+    if config.labeling.engine == "lut":
+        overhead += 2 ** (3 * config.labeling.lut_bits)
+    return overhead
+
+
+def available_memory() -> int | None:
+    """
+    The memory available for new processes, read in /proc/meminfo, or None
+    if it is not there.
+    """
+    meminfo = Path("/proc/meminfo")
+    if not meminfo.is_file():
+        return None
+    for line in meminfo.read_text().splitlines():
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+class MemoryBudget:
+    """
+    Admits jobs while their estimated peak memory fits in the budget left
+    by the workers themselves. A job is always admitted when nothing else
+    is running, so that an image larger than the budget is still processed,
+    alone.
+    """
+
+    def __init__(self, budget: int, config: ColorAndParams) -> None:
+        """
+        :param budget: The memory that the detection may use, in bytes
+        :param config: The configuration of the detector
+        """
+        self.budget: int = budget
+        self.config: ColorAndParams = config
+        self.available: int = budget
+        self.used: int = 0
+        self.sizes: dict[str, tuple[int, int]] = {}
+        self.default_shape: tuple[int, int] | None = None
+
+    def image_memory(self, path: str) -> int:
+        if path not in self.sizes:
+            try:
+                size = image_size(path)
+            except OSError:
+                size = None
+            if size is None:
+                # unknown format: as large as the largest image seen so far
+                size = self.default_shape or (4000, 6000)
+            self.sizes[path] = size
+            if self.default_shape is None or size[0] * size[1] > (
+                self.default_shape[0] * self.default_shape[1]
+            ):
+                self.default_shape = size
+        return image_peak_memory(self.sizes[path], self.config)
+
+    def job_memory(self, folder_job: FolderJob) -> int:
+        """
+        The images of a job are processed one after the other: the job
+        needs as much memory as its largest image.
+        """
+        return max((self.image_memory(path) for _, _, path in folder_job),
+                   default=0)
+
+    def reserve_workers(self, count: int, min_need: int, extra: int = 0) -> int:
+        """
+        Sets aside the memory of the workers, and of `extra` bytes of shared
+        buffers, then tells how many workers fit in the budget: at least
+        one, and as many as possible while each of them can process a job
+        that needs `min_need` bytes.
+        """
+        fixed = worker_overhead(self.config)
+        fitting = (self.budget - extra) // max(1, fixed + min_need)
+        count = max(1, min(count, fitting))
+        self.available = self.budget - extra - count * fixed
+        return count
+
+    def fits(self, need: int) -> bool:
+        return self.used == 0 or self.used + need <= self.available
+
+    def take(self, need: int) -> None:
+        self.used += need
+
+    def give(self, need: int) -> None:
+        self.used = max(0, self.used - need)
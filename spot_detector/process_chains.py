@@ -1,59 +1,416 @@
-from multiprocessing import Process, Queue, parent_process
+import time
+from collections import Counter, deque
+from collections.abc import Callable, Iterator
+from copy import copy
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import count as count_from
+from multiprocessing import Event, Pipe, Process, Queue, parent_process
+from multiprocessing.connection import Connection
+from multiprocessing.connection import wait as wait_pipes
+from multiprocessing.synchronize import Event as EventType
 from pathlib import Path
-from time import sleep
-from typing import Union
+from queue import Empty
 
 import cv2 as cv
 import numpy as np
 from numpy.typing import NDArray
 
-from .config import ColorAndParams, DetParams
+from .config import ColorAndParams, CropParams, DetParams, LabelingParams
+from .detection import (
+    BlobParams,
+    blob_thresholds,
+    detect_components,
+    engine_agreement,
+    shade_aware_params,
+)
 from .transformations import (
-    crop_to_main_circle,
-    evenly_spaced_gray_palette,
-    isolate_categories,
+    build_color_cube_lut,
+    category_luts,
+    circle_edge_score,
+    circle_roi,
+    expanded_distance_terms,
+    find_main_circle,
+    gray_luts,
+    label_img,
+    label_img_blas,
+    label_img_faster,
     label_img_fastest,
+    label_img_ludicrous,
+    label_img_lut,
+    label_img_tiled,
 )
 
-from .types import DataElement, ImageElement
+from .file_utils import image_size
+from .frames import FrameRing
+from .memory import MemoryBudget
+from .result_cache import LabelCache
+from .thread_budget import describe_threads, limit_library_threads, split_threads
+from .types import (Batch, Circle, DataElement, FolderJob, ImageElement,
+                    ImageHint)
 
 RICH_KEYPOINTS = cv.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS
+Labeler = Callable[[NDArray], NDArray]
+Locator = Callable[[NDArray], Circle | None]
+POLL_TIMEOUT = 0.2  # seconds a worker waits for a batch before checking stop
+OLDER_LABELERS: dict[str, Callable[[NDArray, NDArray], NDArray]] = {
+    "plain": label_img,
+    "faster": label_img_faster,
+    "ludicrous": label_img_ludicrous,
+}
+
+
+def get_labeler(color_table: NDArray, settings: LabelingParams) -> Labeler:
+    """
+    Returns the labeling function selected in the configuration, with
+    everything that only depends on the palette already computed.
+    :param color_table: The color table of the configuration
+    :param settings: The labeling settings of the configuration
+    :return: A function taking a BGR image and returning its label map
+    """
+    engine = settings.engine
+    if engine == "lut":
+        lut = build_color_cube_lut(color_table, settings.lut_bits)
+        return partial(label_img_lut, lut=lut)
+    if engine == "tiled":
+        budget = settings.budget_mb * 2**20
+        return partial(label_img_tiled, color_table=color_table, budget=budget)
+    if engine == "blas":
+        cross_weights, sq_norms = expanded_distance_terms(color_table)
+        return partial(
+            label_img_blas, cross_weights=cross_weights, sq_norms=sq_norms
+        )
+    if engine in OLDER_LABELERS:
+        return partial(
+            uint8_labels, labeler=OLDER_LABELERS[engine], color_table=color_table
+        )
+    return partial(label_img_fastest, color_table=color_table)
+
+
+def uint8_labels(
+    img: NDArray,
+    labeler: Callable[[NDArray, NDArray], NDArray],
+    color_table: NDArray,
+) -> NDArray:
+    """
+    Runs one of the older labeling functions, which return int64 labels,
+    and casts its output to the uint8 label map the other engines return.
+    """
+    return labeler(img, color_table).astype(np.uint8)
+
+
+class DishGeometry:
+    """
+    Finds the Petri dish once for all the depths of a sub-directory, which
+    are taken from the same camera position. The first image located is
+    the reference: the following ones reuse its circle as long as the
+    intensity still changes across it (see `circle_edge_score`) at least
+    half as much as on the reference. Otherwise, the dish is searched
+    again and becomes the new reference.
+    """
+
+    consistency: float = 0.5
+
+    def __init__(self, mode: str = "sweep", fast_dog: bool = False) -> None:
+        self.mode: str = mode
+        self.fast_dog: bool = fast_dog
+        self.reference: tuple[Circle, float, tuple[int, ...]] | None = None
+        self.searches: int = 0
+
+    def reset(self) -> None:
+        self.reference = None
+
+    def locate(self, img: NDArray) -> Circle | None:
+        channel = img[:, :, 0] if len(img.shape) == 3 else img
+        if self.reference is not None:
+            circle, score, shape = self.reference
+            if img.shape == shape:
+                new_score = circle_edge_score(channel, circle)
+                if new_score >= self.consistency * score:
+                    return circle
+        self.searches += 1
+        circle = find_main_circle(img, self.mode, self.fast_dog)
+        if circle is not None:
+            score = circle_edge_score(channel, circle)
+            self.reference = (circle, score, img.shape)
+        return circle
+
+
+def load_blob_params(
+    det_params: list[DetParams],
+    color_table: NDArray,
+    luts: NDArray,
+) -> list[tuple[BlobParams, int]]:
+    """
+    The settings of the blob detector of every color, with the threshold
+    schedule reduced to the gray levels of the color when it is enabled.
+    :param det_params: The detection settings of every color
+    :param color_table: The color table of the configuration
+    :param luts: The grayscale palettes of every color, see `gray_luts`
+    :return: For every color, the settings and the number of binarizations
+    saved per image
+    """
+    output = []
+    for settings, lut in zip(det_params, luts):
+        params = settings.load_params(len(color_table))
+        saved = 0
+        if settings.thresh.shade_aware and settings.engine == "blob":
+            params, saved = shade_aware_params(params, lut[:len(color_table)])
+        output.append((params, saved))
+    return output
+
+
+def threshold_savings(config: ColorAndParams) -> tuple[int, int]:
+    """
+    :return: The number of binarizations saved per image by the shade aware
+    threshold schedules, and the number done without them.
+    """
+    color_table = np.array(config.color_data.table)
+    luts = gray_luts(color_table, len(config.det_params))
+    saved, total = 0, 0
+    for settings, (params, color_saved) in zip(
+        config.det_params, load_blob_params(config.det_params, color_table, luts)
+    ):
+        if settings.engine == "blob":
+            saved += color_saved
+            total += len(blob_thresholds(params)) + color_saved
+    return saved, total
+
+
+class DetectionPlan:
+    """
+    Everything the detection derives from the configuration alone: the
+    color table, the labeler, the gray and mask palettes of the colors, the
+    label of what is outside of the dish, the settings of the blob detector
+    and the detectors themselves. A worker builds it once and reuses it for
+    every image, which then only costs pixel work.
+    The detectors keep the contours of the last image they processed: threads
+    must not share them, see `copy`.
+    """
+
+    def __init__(
+        self,
+        color_table: NDArray,
+        det_params: list[DetParams],
+        labeler: Labeler | None = None,
+        luts: NDArray | None = None,
+        blob_params: list[BlobParams] | None = None,
+        labels: LabelCache | None = None,
+    ) -> None:
+        """
+        :param color_table: The color table of the configuration
+        :param det_params: The detection settings of every color
+        :param labeler: The labeling function, `label_img_fastest` by default
+        :param luts: The grayscale palettes of every color, see `gray_luts`
+        :param blob_params: The settings of the blob detector of every color,
+        see `load_blob_params`
+        :param labels: Where the label maps are kept, none by default.
+        """
+        self.color_table: NDArray = color_table
+        self.det_params: list[DetParams] = det_params
+        if labeler is None:
+            labeler = partial(label_img_fastest, color_table=color_table)
+        self.labeler: Labeler = labeler
+        if luts is None:
+            luts = gray_luts(color_table, len(det_params))
+        self.luts: NDArray = luts
+        self.mask_luts: NDArray = category_luts(color_table, len(det_params))
+        if blob_params is None:
+            schedules = load_blob_params(det_params, color_table, luts)
+            blob_params = [params for params, _ in schedules]
+        self.blob_params: list[BlobParams] = blob_params
+        # what is outside of the dish gets the label of a black pixel
+        self.black: int = labeler(np.zeros((1, 1, 3), dtype=np.uint8))[0, 0]
+        self.detectors: list[cv.SimpleBlobDetector | None] = self.new_detectors()
+        self.labels: LabelCache | None = labels
+
+    @classmethod
+    def from_config(
+        cls,
+        config: ColorAndParams,
+        labels: LabelCache | None = None,
+    ) -> "DetectionPlan":
+        color_table = np.array(config.color_data.table)
+        labeler = get_labeler(color_table, config.labeling)
+        return cls(color_table, config.det_params, labeler, labels=labels)
+
+    def new_detectors(self) -> list[cv.SimpleBlobDetector | None]:
+        return [
+            None if settings.engine == "components"
+            else cv.SimpleBlobDetector.create(params)
+            for settings, params in zip(self.det_params, self.blob_params)
+        ]
+
+    def copy(self) -> "DetectionPlan":
+        """
+        A plan for another thread: it shares the tables of this one, but has
+        its own detectors.
+        """
+        plan = copy(self)
+        plan.detectors = plan.new_detectors()
+        return plan
+
+    def set_params(self, i: int, settings: DetParams) -> None:
+        """
+        Replaces the detection settings of the color `i`, only its blob
+        settings and its detector are built again.
+        """
+        self.det_params = [*self.det_params]
+        self.det_params[i] = settings
+        (params, _), = load_blob_params([settings], self.color_table,
+                                        self.luts[i:i + 1])
+        self.blob_params = [*self.blob_params]
+        self.blob_params[i] = params
+        self.detectors = [*self.detectors]
+        self.detectors[i] = (
+            None if settings.engine == "components"
+            else cv.SimpleBlobDetector.create(params)
+        )
+
+    def label(self, img: NDArray, locate: Locator) -> tuple[NDArray, NDArray]:
+        """
+        Crops `img` to its dish and labels it, what is outside of the dish
+        gets the label of a black pixel.
+        :return: The cropped image and its label map
+        """
+        circle = locate(img)
+        outside = None
+        if circle is not None:
+            img, outside = circle_roi(img, circle)
+        labeled = self.labeler(img)
+        if outside is not None:
+            np.copyto(labeled, self.black, where=outside.view(np.bool_))
+        return img, labeled
+
+    def detect_color(self, labeled: NDArray, i: int) -> list[cv.KeyPoint]:
+        params = self.blob_params[i]
+        if self.det_params[i].engine == "components":
+            return detect_components(cv.LUT(labeled, self.mask_luts[i]), params)
+        return self.detectors[i].detect(cv.LUT(labeled, self.luts[i]))
+
+    def count_labels(
+        self,
+        labeled: NDArray,
+        known: list[int | None] | None = None,
+    ) -> list[int]:
+        """
+        Counts the spots of every color of a label map, except those whose
+        count is already `known`.
+        """
+        return [
+            len(self.detect_color(labeled, i))
+            if known is None or known[i] is None else known[i]
+            for i in range(len(self.det_params))
+        ]
+
+    def count_image(
+        self,
+        read: Callable[[], NDArray | None],
+        locate: Locator,
+        hint: ImageHint | None = None,
+    ) -> list[int] | None:
+        """
+        Counts the spots of an image. With the `hint` of the result cache,
+        the colors already counted are not counted again, and the label map
+        is read from the `LabelCache`, if there is one, rather than computed.
+        :param read: Returns the image, only called when it must be labeled
+        :param locate: The function finding the dish, see `DishGeometry`
+        :param hint: The hash of the image and the counts already known
+        :return: The number of spots of every color, None if the image could
+        not be read.
+        """
+        image_hash, known = hint if hint is not None else (None, None)
+        labeled = None
+        if image_hash is not None and self.labels is not None:
+            labeled = self.labels.load(image_hash)
+        if labeled is None:
+            img = read()
+            if img is None:
+                return None
+            _, labeled = self.label(img, locate)
+            del img
+            if image_hash is not None and self.labels is not None:
+                self.labels.save(image_hash, labeled)
+        return self.count_labels(labeled, known)
+
+    def count_spots(
+        self,
+        img: NDArray,
+        locate: Locator,
+        debug: int = 0,
+    ) -> list[int]:
+        """
+        Counts the spots of every color in the dish of `img`.
+        :param img: A BGR image
+        :param locate: The function finding the dish, see `DishGeometry`
+        :param debug: The level of debug output, 0 for none
+        :return: The number of spots of every color
+        """
+        img, labeled = self.label(img, locate)
+        values = []
+        for i in range(len(self.det_params)):
+            key_points = self.detect_color(labeled, i)
+            values.append(len(key_points))
+            if debug >= 1:
+                self.debug_color(labeled, i, key_points, debug)
+        if debug >= 1:
+            cv.imwrite(expand_debug("crop_km.jpg"), img)
+        if debug >= 3:
+            cv.imwrite(expand_debug("labled_km.png"), labeled)
+        return values
+
+    def debug_color(
+        self,
+        labeled: NDArray,
+        i: int,
+        key_points: list[cv.KeyPoint],
+        debug: int,
+    ) -> None:
+        j = i + 1  # 0 is the bg
+        gs_img = cv.LUT(labeled, self.luts[i])
+        if debug >= 2:
+            mask = cv.LUT(labeled, self.mask_luts[i])
+            blob_count, component_count = engine_agreement(
+                gs_img, mask, self.blob_params[i]
+            )
+            print(
+                f"col{j}: blob {blob_count}, components {component_count}"
+                f" ({component_count - blob_count:+})"
+            )
+        kp = cv.drawKeypoints(
+            gs_img,
+            key_points,
+            None, # type: ignore
+            [0, 0, 255],
+            RICH_KEYPOINTS
+        )
+        cv.imwrite(expand_debug(f"col{j}_kp_km.jpg"), kp)
+        cv.imwrite(expand_debug(f"col{j}_gs_km.jpg"), gs_img)
+
 
 def count_spots_fourth_method(
     img: NDArray,
     color_table: NDArray,
     det_params: list[DetParams],
     debug: int = 0,
+    labeler: Labeler | None = None,
+    luts: NDArray | None = None,
+    crop: CropParams | None = None,
+    locate: Locator | None = None,
+    blob_params: list[BlobParams] | None = None,
 ) -> list[int]:
-    img = crop_to_main_circle(img)
-    labeled = label_img_fastest(img, color_table)
-    values = []
-    for i, settings in enumerate(det_params):
-        detector = cv.SimpleBlobDetector.create(
-            settings.load_params(len(color_table))
+    """
+    Counts the spots of a single image. To process many images, build a
+    `DetectionPlan` once and call its `count_spots` method instead.
+    """
+    if locate is None:
+        if crop is None:
+            crop = CropParams()
+        locate = partial(
+            find_main_circle, mode=crop.mode, fast_dog=crop.fast_dog
         )
-        j = i + 1  # 0 is the bg
-        isolated_color = isolate_categories(color_table, [j])
-        gs_palette = evenly_spaced_gray_palette(isolated_color)
-        gs_img = gs_palette[labeled.flatten()]
-        gs_img = gs_img.reshape(labeled.shape).astype(np.uint8)
-        key_points = detector.detect(gs_img)
-        values.append(len(key_points))
-        if debug >= 1:
-            kp = cv.drawKeypoints(
-                gs_img,
-                key_points,
-                None, # type: ignore
-                [0, 0, 255],
-                RICH_KEYPOINTS
-            )
-            cv.imwrite(expand_debug(f"col{j}_kp_km.jpg"), kp)
-            cv.imwrite(expand_debug(f"col{j}_gs_km.jpg"), gs_img)
-    if debug >= 1:
-        cv.imwrite(expand_debug("crop_km.jpg"), img)
-    if debug >= 3:
-        cv.imwrite(expand_debug("labled_km.png"), labeled)
-    return values
+    plan = DetectionPlan(color_table, det_params, labeler, luts, blob_params)
+    return plan.count_spots(img, locate, debug)
 
 
 def expand_debug(string: str) -> str:
@@ -63,63 +420,831 @@ def expand_debug(string: str) -> str:
 
 
 
-def init_workers(
-    count: int,
-    config: ColorAndParams,
-    in_queue: Queue,
-    out_queue: Queue,
-) -> list[Process]:
-    """
-    Creates a list of multiprocessing process objects but does not call
-    their start method.
-    :param count: The number of processes to create
-    :param config: The configuration of the detector for each label
-    :param in_queue: The queue from which the processes fetch their input data
-    :param out_queue: The queue to which the processed data is output
-    :return: The list of process objects
-    """
-    workers_list = []
-    for _ in range(count):
+class WorkerPool:
+    """
+    A pool of worker processes fed by the parent process. Every worker has
+    its own inbox, and the parent sends it batches of jobs as soon as it
+    has room for them: the workers never poll, and the parent blocks on
+    their messages with a timeout that is only used to supervise them.
+    Every worker and decoder sends its messages through its own pipe, so
+    that one of them can be killed without blocking the others.
+    When every result came back, the workers are stopped with an event.
+    The parent knows which image each worker is processing. A worker that
+    dies, or that spends more than `image_timeout` on an image, is replaced:
+    the images of its batches that were not processed yet are sent again,
+    and the image that was being processed is put in quarantine once it
+    made workers fail `max_attempts` times.
+    With decoders, the batches go through a decoder process first, that
+    reads the images ahead of the workers and hands them over in a
+    `FrameRing`, so that reading and decoding overlap the computations.
+    They share the ring and the inboxes: when one of them, or a worker,
+    has to be replaced, they are all replaced.
+    With a `MemoryBudget`, a batch is only sent when its estimated memory
+    fits in what the running batches left, and the number of workers is
+    limited to what the budget can hold.
+    """
+
+    prefetch: int = 2  # batches queued per worker, so it never waits
+    lookahead: int = 16  # batches considered when the next one is too large
+    result_timeout: float = 1.0
+
+    def __init__(
+        self,
+        count: int,
+        config: ColorAndParams,
+        max_batch: int = 4,
+        decoders: int = 0,
+        memory: MemoryBudget | None = None,
+        thread_budget: int | None = None,
+        image_timeout: float | None = None,
+        max_attempts: int = 2,
+        labels: LabelCache | None = None,
+    ) -> None:
+        """
+        :param count: The number of processes
+        :param config: The configuration of the detector. Must be picklable.
+        :param max_batch: The maximum number of jobs sent at once
+        :param decoders: The number of decoder processes, none by default:
+        the workers read their images themselves.
+        :param memory: The memory budget of the detection, none by default.
+        :param thread_budget: The total number of threads, split between the
+        workers and their OpenCV and BLAS threads (see `split_threads`).
+        By default, the libraries use as many threads as they want.
+        :param image_timeout: The time in seconds after which a worker, or a
+        decoder, is stopped if it is still on the same image. None to wait
+        indefinitely.
+        :param max_attempts: The number of failed workers after which an
+        image is put in quarantine.
+        :param labels: Where the workers keep the label maps of the images
+        that have a hint (see `run`), none by default.
+        """
+        self.count: int = max(1, count)
+        self.config: ColorAndParams = config
+        self.max_batch: int = max(1, max_batch)
+        self.decoder_count: int = max(0, min(decoders, self.count))
+        self.stop: EventType = Event()
+        self.inboxes: list[Queue] = []
+        self.workers: list[Process] = []
+        self.worker_pipes: list[Connection] = []
+        self.decoder_pipes: list[Connection] = []
+        self.in_flight: list[dict[int, Batch]] = []
+        self.feeds: list[Queue] = []
+        self.decoders: list[Process] = []
+        self.ring: FrameRing | None = None
+        self.memory: MemoryBudget | None = memory
+        self.reserved: dict[int, int] = {}
+        self.thread_budget: int | None = thread_budget
+        self.library_threads: int = 0
+        self.image_timeout: float | None = image_timeout
+        self.max_attempts: int = max(1, max_attempts)
+        self.labels: LabelCache | None = labels
+        self.hints: dict[tuple[int, int], ImageHint] = {}
+        self.pending: deque[tuple[int, Batch]] = deque()
+        self.batch_ids: Iterator[int] = count_from(0)
+        # (image, batch_id, start time) of each busy worker or decoder
+        self.current: dict[int, tuple[ImageElement, int, float]] = {}
+        self.decoding: dict[int, tuple[ImageElement, int, float]] = {}
+        self.finished: dict[int, set[tuple[int, int]]] = {}
+        self.crashes: Counter[tuple[int, int]] = Counter()
+        # crashes in a row of each process before it starts an image
+        self.idle_crashes: Counter[int] = Counter()
+        self.overtaken: Counter[int] = Counter()  # by batch id, see next_batch
+        self.quarantined: list[tuple[str, str]] = []
+        # seconds spent on each image by a worker, by (row, column)
+        self.durations: dict[tuple[int, int], float] = {}
+        self.results: deque[DataElement] = deque()
+        if memory is not None:
+            # a queued batch holds its memory too
+            self.prefetch = 1
+
+    def make_batches(self, jobs: list[FolderJob]) -> list[Batch]:
+        """
+        Groups the jobs in batches, smaller at the end of the list so that
+        the workers finish at the same time: every batch holds a quarter of
+        the share of each worker in the jobs left after it, at most
+        `max_batch` jobs, down to a single job.
+        """
+        batches = []
+        start = 0
+        while start < len(jobs):
+            left = len(jobs) - start
+            size = max(1, min(self.max_batch, left // (4 * self.count)))
+            batches.append(jobs[start:start + size])
+            start += size
+        return batches
+
+    def start(self, slot_size: int = 0) -> None:
+        """
+        :param slot_size: The size of the slots of the `FrameRing`, in bytes,
+        when there are decoders. Larger images are read by the workers.
+        """
+        if self.decoder_count:
+            # every worker processes one image while the next one waits
+            slots = 2 * self.count + self.decoder_count
+            self.ring = FrameRing(slots, slot_size)
+        if self.thread_budget is not None:
+            _, self.library_threads = split_threads(self.thread_budget,
+                                                    self.count)
+        for worker_id in range(self.count):
+            self.inboxes.append(Queue())
+            self.in_flight.append({})
+            worker, pipe = self.spawn_worker(worker_id)
+            self.workers.append(worker)
+            self.worker_pipes.append(pipe)
+        for decoder_id in range(self.decoder_count):
+            self.feeds.append(Queue())
+            decoder, pipe = self.spawn_decoder(decoder_id)
+            self.decoders.append(decoder)
+            self.decoder_pipes.append(pipe)
+
+    def spawn_worker(self, worker_id: int) -> tuple[Process, Connection]:
+        receiver, sender = Pipe(duplex=False)
         worker = Process(
-            target=img_processer, args=(in_queue, out_queue, config)
+            target=img_processer,
+            args=(worker_id, self.inboxes[worker_id], sender, self.stop,
+                  self.config, self.ring, self.library_threads, self.labels),
+            daemon=True,
+        )
+        worker.start()
+        # the pipe is seen as closed as soon as the worker is gone
+        sender.close()
+        return worker, receiver
+
+    def spawn_decoder(self, decoder_id: int) -> tuple[Process, Connection]:
+        receiver, sender = Pipe(duplex=False)
+        decoder = Process(
+            target=img_decoder,
+            args=(self.feeds[decoder_id], self.inboxes, sender, self.stop,
+                  self.ring, self.labels),
+            daemon=True,
+        )
+        decoder.start()
+        sender.close()
+        return decoder, receiver
+
+    def plan_memory(self, jobs: list[FolderJob], slot_size: int) -> None:
+        """
+        Limits the number of workers to what the memory budget can hold,
+        and tells what was estimated.
+        """
+        needs = [self.memory.job_memory(folder_job) for folder_job in jobs]
+        ring_size = 0
+        if self.decoder_count:
+            ring_size = (2 * self.count + self.decoder_count) * slot_size
+        count = self.memory.reserve_workers(self.count, min(needs), ring_size)
+        print(
+            f"Mémoire : {count} processus, de {min(needs) // 2**20} à "
+            f"{max(needs) // 2**20} Mo par image, "
+            f"budget de {self.memory.budget // 2**20} Mo."
         )
-        workers_list.append(worker)
-    return workers_list
+        self.count = count
+        self.decoder_count = min(self.decoder_count, count)
+
+    def next_batch(self) -> tuple[int, Batch] | None:
+        """
+        The next batch to send: without a memory budget, the first one. With
+        a budget, the first one of the next `lookahead` batches that fits in
+        the memory left, so that the workers do not wait while a large batch
+        can not be sent. The batches are sorted longest first (see
+        `core.longest_first`): to keep that order, the first batch may only
+        be overtaken `lookahead` times, after which nothing is sent until
+        it fits.
+        """
+        if self.memory is None:
+            return self.pending.popleft()
+        first_id = self.pending[0][0]
+        window = self.lookahead
+        if self.overtaken[first_id] >= self.lookahead:
+            window = 1
+        for i in range(min(window, len(self.pending))):
+            batch_id, batch = self.pending[i]
+            need = max(map(self.memory.job_memory, batch))
+            if self.memory.fits(need):
+                del self.pending[i]
+                self.memory.take(need)
+                self.reserved[batch_id] = need
+                if i > 0:
+                    self.overtaken[first_id] += 1
+                else:
+                    self.overtaken.pop(first_id, None)
+                return batch_id, batch
+        return None
+
+    def forget(self, worker_id: int, batch_id: int) -> None:
+        self.in_flight[worker_id].pop(batch_id, None)
+        self.finished.pop(batch_id, None)
+        if self.memory is not None:
+            self.memory.give(self.reserved.pop(batch_id, 0))
+
+    def dispatch(self) -> None:
+        for worker_id in range(self.count):
+            in_flight = self.in_flight[worker_id]
+            while self.pending and len(in_flight) < self.prefetch:
+                chosen = self.next_batch()
+                if chosen is None:
+                    return
+                batch_id, batch = chosen
+                in_flight[batch_id] = batch
+                if self.decoders:
+                    # a worker is always fed by the same decoder, so that
+                    # the images of its batches arrive in order
+                    feed = self.feeds[worker_id % self.decoder_count]
+                    hints = batch_hints(batch, self.hints)
+                    feed.put((worker_id, batch_id, batch, hints))
+                else:
+                    send_batch(self.inboxes[worker_id], batch_id, batch,
+                               batch_hints(batch, self.hints))
+
+    def timed_out(self, task: tuple[ImageElement, int, float] | None) -> bool:
+        if task is None or self.image_timeout is None:
+            return False
+        return time.monotonic() - task[2] > self.image_timeout
+
+    def next_check(self) -> float:
+        """
+        How long to wait for messages before supervising the processes
+        again: until the first image would time out, at most
+        `result_timeout`.
+        """
+        tasks = list(self.current.values()) + list(self.decoding.values())
+        if self.image_timeout is None or not tasks:
+            return self.result_timeout
+        deadline = min(start for _, _, start in tasks) + self.image_timeout
+        return max(0.0, min(self.result_timeout, deadline - time.monotonic()))
+
+    def supervise(self) -> None:
+        """
+        Replaces the workers and decoders that died or that are stuck on an
+        image, and sends their unfinished images again.
+        """
+        for decoder_id, decoder in enumerate(self.decoders):
+            task = self.decoding.get(decoder_id)
+            if decoder.is_alive() and not self.timed_out(task):
+                continue
+            reason = self.stop_process(decoder)
+            self.read_all(self.decoder_pipes[decoder_id])
+            task = self.decoding.pop(decoder_id, None)
+            self.count_idle_crash(-1 - decoder_id, task, reason)
+            self.restart(task, reason)
+            return
+        for worker_id, worker in enumerate(self.workers):
+            task = self.current.get(worker_id)
+            if worker.is_alive() and not self.timed_out(task):
+                continue
+            reason = self.stop_process(worker)
+            # the results sent before the end are still valid
+            self.read_all(self.worker_pipes[worker_id])
+            task = self.current.pop(worker_id, None)
+            self.count_idle_crash(worker_id, task, reason)
+            if self.decoders:
+                self.restart(task, reason)
+                return
+            self.requeue([worker_id], task, reason)
+            # the inbox may be locked by the worker that was killed
+            self.discard_queues([self.inboxes[worker_id]])
+            self.inboxes[worker_id] = Queue()
+            worker, pipe = self.spawn_worker(worker_id)
+            self.workers[worker_id] = worker
+            self.worker_pipes[worker_id] = pipe
+
+    def count_idle_crash(
+        self,
+        key: int,
+        task: tuple[ImageElement, int, float] | None,
+        reason: str,
+    ) -> None:
+        """
+        Stops the pool when a process keeps dying before it starts an image:
+        there is no image to put in quarantine, and replacing it would never
+        end.
+        :param key: The id of a worker, or -1 - the id of a decoder
+        :param task: What the process was doing when it stopped
+        :raise RuntimeError: after `max_attempts` crashes in a row.
+        """
+        if task is not None:
+            return
+        self.idle_crashes[key] += 1
+        if self.idle_crashes[key] >= self.max_attempts:
+            raise RuntimeError(
+                f"Un processus s'est arrêté {self.idle_crashes[key]} fois de "
+                f"suite avant de commencer une image ({reason}), le "
+                "traitement est interrompu."
+            )
+
+    def restart(
+        self,
+        task: tuple[ImageElement, int, float] | None,
+        reason: str,
+    ) -> None:
+        """
+        Replaces every worker and decoder, with a new ring and new queues.
+        A process killed with decoders may take a slot of the ring, or the
+        lock of a queue shared with the others, with it: the decoding chain
+        is only safe to use again from scratch.
+        """
+        processes = self.workers + self.decoders
+        pipes = self.worker_pipes + self.decoder_pipes
+        for process, pipe in zip(processes, pipes):
+            if process.is_alive():
+                process.kill()
+                process.join()
+            self.read_all(pipe)
+        self.requeue(list(range(self.count)), task, reason)
+        self.current.clear()
+        self.decoding.clear()
+        self.discard_queues(self.feeds + self.inboxes)
+        slot_size = self.ring.slot_size
+        self.ring.unlink()
+        self.inboxes, self.workers, self.worker_pipes = [], [], []
+        self.feeds, self.decoders, self.decoder_pipes = [], [], []
+        self.in_flight = []
+        self.start(slot_size)
+
+    def discard_queues(self, queues: list[Queue]) -> None:
+        """
+        Closes queues that a killed process may have left locked, without
+        waiting for their feeder threads to flush what nobody will read.
+        """
+        for queue in queues:
+            queue.cancel_join_thread()
+            queue.close()
+
+    def stop_process(self, process: Process) -> str:
+        if process.is_alive():
+            process.kill()
+            process.join()
+            return f"plus de {self.image_timeout:g} s sur une image"
+        return f"processus arrêté (code {process.exitcode})"
+
+    def requeue(
+        self,
+        worker_ids: list[int],
+        task: tuple[ImageElement, int, float] | None,
+        reason: str,
+    ) -> None:
+        """
+        Sends the unfinished images of the batches of `worker_ids` again, in
+        new batches, at the front of the queue. The image of `task`, that
+        was being processed, is retried unless it already failed
+        `max_attempts` times.
+        """
+        culprit = None
+        if task is not None:
+            element = task[0]
+            culprit = element[0:2]
+            self.crashes[culprit] += 1
+            if self.crashes[culprit] >= self.max_attempts:
+                self.quarantined.append((element[2], reason))
+                print(f"\n{element[2]} mis en quarantaine : {reason}.")
+            else:
+                print(f"\n{element[2]} : {reason}, nouvel essai.")
+                culprit = None
+        jobs: list[FolderJob] = []
+        for worker_id in worker_ids:
+            for batch_id, batch in list(self.in_flight[worker_id].items()):
+                done = self.finished.get(batch_id, set())
+                for folder_job in batch:
+                    rest = [e for e in folder_job
+                            if e[0:2] not in done and e[0:2] != culprit]
+                    if rest:
+                        jobs.append(rest)
+                self.forget(worker_id, batch_id)
+        for folder_job in reversed(jobs):
+            self.pending.appendleft((next(self.batch_ids), [folder_job]))
+
+    def read_all(self, pipe: Connection) -> None:
+        """
+        Receives every message left in the pipe of a process that stopped.
+        """
+        try:
+            while pipe.poll():
+                self.receive(pipe.recv())
+        except (EOFError, OSError):
+            pass
+        pipe.close()
+
+    def receive(self, message: tuple) -> None:
+        """
+        Updates the state of the pool with a message of a worker or of a
+        decoder, and keeps the result it holds, if any. The messages of the
+        batches that were sent again are ignored.
+        """
+        kind, worker_id, batch_id, content = message
+        if kind == "decoded":
+            # the batch may be over already, when the image was the last one
+            self.decoding.pop(worker_id % self.decoder_count, None)
+            return
+        if batch_id not in self.in_flight[worker_id]:
+            return
+        now = time.monotonic()
+        if kind == "start":
+            self.current[worker_id] = (content, batch_id, now)
+            self.idle_crashes.pop(worker_id, None)
+        elif kind == "decoding":
+            decoder_id = worker_id % self.decoder_count
+            self.decoding[decoder_id] = (content, batch_id, now)
+            self.idle_crashes.pop(-1 - decoder_id, None)
+        elif kind == "done":
+            self.current.pop(worker_id, None)
+            self.forget(worker_id, batch_id)
+        elif kind == "failed":
+            element, error = content
+            self.finished.setdefault(batch_id, set()).add(element[0:2])
+            task = self.current.get(worker_id)
+            if task is not None and task[0] == element:
+                # the decoders report failures too, not only the worker
+                del self.current[worker_id]
+            print(f"\nÉchec du traitement de {error}")
+        elif kind == "result":
+            self.finished.setdefault(batch_id, set()).add(content[0:2])
+            task = self.current.pop(worker_id, None)
+            if task is not None and task[0][0:2] == content[0:2]:
+                self.durations[content[0:2]] = now - task[2]
+            self.results.append(content)
+
+    def run(
+        self,
+        jobs: list[FolderJob],
+        hints: dict[tuple[int, int], ImageHint] | None = None,
+    ) -> Iterator[DataElement]:
+        """
+        Processes the jobs and yields the results as soon as they arrive.
+        Every `FolderJob` is processed by a single worker, its images share
+        the same dish.
+        :param hints: For the images of the result cache, by (row, column),
+        their hash and the counts already known (see `ResultCache.lookup`).
+        """
+        batches = self.make_batches(jobs)
+        if not batches:
+            return
+        self.hints = hints or {}
+        self.pending = deque((next(self.batch_ids), b) for b in batches)
+        slot_size = frame_size(jobs[0][0][2]) if self.decoder_count else 0
+        if self.memory is not None:
+            self.plan_memory(jobs, slot_size)
+        self.start(slot_size)
+        if self.thread_budget is not None:
+            print(describe_threads(self.count, self.library_threads,
+                                   self.thread_budget))
+        try:
+            while self.pending or any(self.in_flight) or self.results:
+                self.dispatch()
+                pipes = self.worker_pipes + self.decoder_pipes
+                for pipe in wait_pipes(pipes, timeout=self.next_check()):
+                    try:
+                        self.receive(pipe.recv())
+                    except (EOFError, OSError):
+                        pass  # the process is gone, see `supervise`
+                self.supervise()
+                while self.results:
+                    yield self.results.popleft()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self.stop.set()
+        for process in self.decoders + self.workers:
+            process.join(timeout=2 * POLL_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        for queue in self.feeds + self.inboxes:
+            queue.close()
+        for pipe in self.worker_pipes + self.decoder_pipes:
+            pipe.close()
+        if self.ring is not None:
+            self.ring.unlink()
+
+
+def frame_size(path: str) -> int:
+    """
+    The size in bytes of the decoded image of `path`, read in its header if
+    possible.
+    """
+    try:
+        size = image_size(path)
+    except OSError:
+        size = None
+    if size is not None:
+        return size[0] * size[1] * 3
+    img = cv.imread(path)
+    return 0 if img is None else img.nbytes
+
+
+def batch_hints(
+    batch: Batch,
+    hints: dict[tuple[int, int], ImageHint],
+) -> dict[tuple[int, int], ImageHint]:
+    return {element[0:2]: hints[element[0:2]] for folder_job in batch
+            for element in folder_job if element[0:2] in hints}
+
+
+def send_batch(
+    inbox: Queue,
+    batch_id: int,
+    batch: Batch,
+    hints: dict[tuple[int, int], ImageHint],
+) -> None:
+    """
+    Sends the images of a batch to a worker, one message per image:
+    (batch_id, job_index, ImageElement, Frame or None, ImageHint or None),
+    then (batch_id, -1, None, None, None) at the end of the batch.
+    """
+    for job_index, folder_job in enumerate(batch):
+        for element in folder_job:
+            hint = hints.get(element[0:2])
+            inbox.put((batch_id, job_index, element, None, hint))
+    inbox.put((batch_id, -1, None, None, None))
+
+
+def labels_cached(labels: LabelCache | None, hint: ImageHint | None) -> bool:
+    """
+    Whether the label map of the image is in `labels`, the image then does
+    not need to be decoded.
+    """
+    return (labels is not None and hint is not None
+            and labels.path(hint[0]).exists())
+
+
+def img_decoder(
+    feed: Queue,
+    inboxes: list[Queue],
+    outbox: Connection,
+    stop: EventType,
+    ring: FrameRing,
+    labels: LabelCache | None = None,
+) -> None:
+    """
+    The target function of the decoders. They read the images of the
+    (worker_id, batch_id, `Batch`, hints) they get from `feed`, write them in
+    a free slot of `ring` and send them to the inbox of the worker, with the
+    same messages as `send_batch`. The images too large for a slot, and
+    those whose label map is in `labels`, are sent without a frame: the
+    worker reads them, or their label map, itself. They send a
+    ("decoding", worker_id, batch_id, ImageElement) message before reading
+    an image and a ("decoded", worker_id, batch_id, None) one after it.
+    """
+    # reading and decoding is not worth more threads than the workers'
+    limit_library_threads(1)
+    parent = parent_process()
+    if parent is None:
+        return
+    while not stop.is_set() and parent.is_alive():
+        try:
+            worker_id, batch_id, batch, hints = feed.get(timeout=POLL_TIMEOUT)
+        except Empty:
+            continue
+        inbox = inboxes[worker_id]
+        for job_index, folder_job in enumerate(batch):
+            for element in folder_job:
+                path = element[2]
+                hint = hints.get(element[0:2])
+                if labels_cached(labels, hint):
+                    inbox.put((batch_id, job_index, element, None, hint))
+                    continue
+                try:
+                    size = image_size(path)
+                except OSError:
+                    size = None
+                if size is not None and not ring.fits((*size, 3)):
+                    inbox.put((batch_id, job_index, element, None, hint))
+                    continue
+                slot = ring.acquire(stop, POLL_TIMEOUT)
+                if slot is None:
+                    return
+                outbox.send(("decoding", worker_id, batch_id, element))
+                img = cv.imread(path)
+                outbox.send(("decoded", worker_id, batch_id, None))
+                if img is None:
+                    ring.release(slot)
+                    failure = (element, path)
+                    outbox.send(("failed", worker_id, batch_id, failure))
+                    continue
+                if not ring.fits(img.shape):
+                    ring.release(slot)
+                    inbox.put((batch_id, job_index, element, None, hint))
+                    continue
+                frame = ring.write(slot, img)
+                inbox.put((batch_id, job_index, element, frame, hint))
+        inbox.put((batch_id, -1, None, None, None))
+    ring.close()
+
+
+class ThreadWorkerPool:
+    """
+    Runs the same computations as `WorkerPool` in threads of the parent
+    process instead of worker processes. OpenCV and NumPy release the GIL
+    during the heavy calls, and the threads share a single copy of the
+    configuration, labeler and LUTs (see `DetectionPlan`): memory only
+    grows with the images being processed, and there is no process to
+    start.
+    """
+
+    def __init__(
+        self,
+        count: int,
+        config: ColorAndParams,
+        memory: MemoryBudget | None = None,
+        thread_budget: int | None = None,
+        labels: LabelCache | None = None,
+    ) -> None:
+        """
+        :param count: The number of threads
+        :param config: The configuration of the detector
+        :param memory: The memory budget of the detection, none by default.
+        A job only starts when its estimated memory fits in what the
+        running ones left.
+        :param thread_budget: The total number of threads, split between the
+        threads of the pool and those of OpenCV and BLAS.
+        :param labels: Where the label maps are kept, see `WorkerPool`.
+        """
+        self.count: int = max(1, count)
+        self.config: ColorAndParams = config
+        self.memory: MemoryBudget | None = memory
+        self.thread_budget: int | None = thread_budget
+        self.labels: LabelCache | None = labels
+        # a thread cannot be stopped, nothing is ever put in quarantine
+        self.quarantined: list[tuple[str, str]] = []
+        self.overtaken: int = 0  # times the first job was, see next_job
+        self.durations: dict[tuple[int, int], float] = {}  # see WorkerPool
+
+    def run(
+        self,
+        jobs: list[FolderJob],
+        hints: dict[tuple[int, int], ImageHint] | None = None,
+    ) -> Iterator[DataElement]:
+        """
+        Processes the jobs and yields the results of every job as soon as it
+        is over. Every `FolderJob` is processed by a single thread, its
+        images share the same dish.
+        :param hints: See `WorkerPool.run`
+        """
+        if not jobs:
+            return
+        hints = hints or {}
+        if self.memory is not None:
+            needs = [self.memory.job_memory(folder_job) for folder_job in jobs]
+            # the threads share the memory of a single worker
+            self.memory.reserve_workers(1, min(needs))
+            print(
+                f"Mémoire : {self.count} fils, de {min(needs) // 2**20} à "
+                f"{max(needs) // 2**20} Mo par image, "
+                f"budget de {self.memory.budget // 2**20} Mo."
+            )
+        plan = DetectionPlan.from_config(self.config, self.labels)
+        pending = deque(jobs)
+        running: dict[Future, int] = {}
+        restore_limits = None
+        if self.thread_budget is not None:
+            # the threads of the pool share those of the libraries
+            _, library_threads = split_threads(self.thread_budget, self.count)
+            restore_limits = limit_library_threads(library_threads)
+            print(describe_threads(self.count, library_threads,
+                                   self.thread_budget, "fils de traitement"))
+        executor = ThreadPoolExecutor(self.count)
+        try:
+            while pending or running:
+                while pending and len(running) < self.count:
+                    chosen = self.next_job(pending)
+                    if chosen is None:
+                        break
+                    folder_job, need = chosen
+                    future = executor.submit(self.process_job, folder_job,
+                                             plan, hints)
+                    running[future] = need
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    need = running.pop(future)
+                    if self.memory is not None:
+                        self.memory.give(need)
+                    results, failures = future.result()
+                    for message in failures:
+                        print(f"\nÉchec du traitement de {message}")
+                    yield from results
+        finally:
+            executor.shutdown(cancel_futures=True)
+            if restore_limits is not None:
+                restore_limits()
+
+    def next_job(self, pending: deque[FolderJob]) -> tuple[FolderJob, int] | None:
+        """
+        The next job to start and its memory: the first one, or with a
+        memory budget, the first one of the next few that fits. The first
+        job is overtaken at most `WorkerPool.lookahead` times, see
+        `WorkerPool.next_batch`.
+        """
+        if self.memory is None:
+            return pending.popleft(), 0
+        window = WorkerPool.lookahead
+        if self.overtaken >= WorkerPool.lookahead:
+            window = 1
+        for i in range(min(window, len(pending))):
+            need = self.memory.job_memory(pending[i])
+            if self.memory.fits(need):
+                folder_job = pending[i]
+                del pending[i]
+                self.memory.take(need)
+                self.overtaken = self.overtaken + 1 if i > 0 else 0
+                return folder_job, need
+        return None
+
+    def process_job(
+        self,
+        folder_job: FolderJob,
+        plan: DetectionPlan,
+        hints: dict[tuple[int, int], ImageHint],
+    ) -> tuple[list[DataElement], list[str]]:
+        plan = plan.copy()
+        geometry = DishGeometry(self.config.crop.mode, self.config.crop.fast_dog)
+        results: list[DataElement] = []
+        failures: list[str] = []
+        for folder_row, depth_col, path in folder_job:
+            hint = hints.get((folder_row, depth_col))
+            start = time.monotonic()
+            try:
+                values = plan.count_image(partial(cv.imread, path),
+                                          geometry.locate, hint)
+            except Exception as error:
+                failures.append(f"{path} ({type(error).__name__}: {error})")
+                continue
+            if values is None:
+                failures.append(path)
+                continue
+            results.append((folder_row, depth_col, values))
+            duration = time.monotonic() - start
+            self.durations[(folder_row, depth_col)] = duration
+        return results, failures
 
 
 def img_processer(
-    in_queue: Queue,
-    out_queue: Queue,
+    worker_id: int,
+    inbox: Queue,
+    outbox: Connection,
+    stop: EventType,
     config: ColorAndParams,
+    ring: FrameRing | None = None,
+    library_threads: int = 0,
+    labels: LabelCache | None = None,
 ) -> None:
     """
-    The target function if the workers. The workers terminate when they
-    recieve a "STOP" string.
-    `in_queue`: `multiprocessing.Queue` from which the function fetches
-    `ImageElement`s.
-    `out_queue`: `multiprocessing.Queue` to which processed data are output
+    The target function of the workers. The workers wait for images on
+    their inbox, and terminate when `stop` is set or when the parent process
+    is gone. They send a ("start", worker_id, batch_id, ImageElement)
+    message when they start an image, a ("result", ..., DataElement) or a
+    ("failed", ..., (ImageElement, message)) one when it is over, then
+    ("done", worker_id, batch_id, None) at the end of every batch.
+    `worker_id`: The index of the worker in its pool
+    `inbox`: `multiprocessing.Queue` from which the function fetches
+    the images, see `send_batch`.
+    `outbox`: The sending end of the pipe to which the messages are sent
+    `stop`: `multiprocessing.Event` set when the work is over
     `config`: An object containing the different configurations necessary
     for computation. Must be picklable.
+    `ring`: The `FrameRing` of the decoded images, if there are decoders.
+    `library_threads`: The number of threads of OpenCV and BLAS in this
+    worker, 0 to leave them as they are.
+    `labels`: Where the label maps are kept, if anywhere.
     """
-    color_table = np.array(config.color_data.table)
+    if library_threads > 0:
+        limit_library_threads(library_threads)
+    plan = DetectionPlan.from_config(config, labels)
+    geometry = DishGeometry(config.crop.mode, config.crop.fast_dog)
+    current_job = None
     parent = parent_process()
     if parent is None:
         return
-    while parent.is_alive():
-        if in_queue.empty():
-            sleep(1)
+    while not stop.is_set() and parent.is_alive():
+        try:
+            message = inbox.get(timeout=POLL_TIMEOUT)
+        except Empty:
+            continue
+        batch_id, job_index, element, frame, hint = message
+        if element is None:
+            outbox.send(("done", worker_id, batch_id, None))
+            continue
+        if (batch_id, job_index) != current_job:
+            # A new dish for every job: only the images of a job share one
+            geometry.reset()
+            current_job = (batch_id, job_index)
+        folder_row, depth_col, path = element
+        outbox.send(("start", worker_id, batch_id, element))
+        if frame is None:
+            read = partial(cv.imread, path)
         else:
-            job: Union[str, ImageElement] = in_queue.get()
-            if isinstance(job, str):
-                if job == "STOP":
-                    break
-                else:
-                    print("How? WHy?")
-            else:
-                folder_row, depth_col, path = job
-                img = cv.imread(path)
-                values = count_spots_fourth_method(
-                    img, color_table, config.det_params
-                )
-                result: DataElement = (folder_row, depth_col, values)
-                out_queue.put(result)
+            read = partial(ring.view, frame)
+        try:
+            values = plan.count_image(read, geometry.locate, hint)
+            if values is None:
+                failure = (element, path)
+                outbox.send(("failed", worker_id, batch_id, failure))
+                continue
+        except Exception as error:
+            failure = (element, f"{path} ({type(error).__name__}: {error})")
+            outbox.send(("failed", worker_id, batch_id, failure))
+            continue
+        finally:
+            if frame is not None:
+                ring.release(frame[0])
+        result: DataElement = (folder_row, depth_col, values)
+        outbox.send(("result", worker_id, batch_id, result))
+    if ring is not None:
+        ring.close()
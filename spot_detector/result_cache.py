@@ -0,0 +1,218 @@
+# Python standard library
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import get_ident
+
+# Other
+import numpy as np
+from numpy.typing import NDArray
+
+# Project files
+from .config import ColorAndParams
+from .types import DataElement, ImageElement, ImageHint
+
+# Changed whenever a change of the detection itself changes the counts, so
+# that the results of the previous versions are not used anymore.
+CACHE_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS color_counts (
+    image TEXT NOT NULL,
+    palette TEXT NOT NULL,
+    color TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (image, palette, color)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+FileHash = tuple[int, int, str]  # (size, mtime in ns, hash) of a file
+
+
+def default_cache_path() -> Path:
+    """
+    The cache of the user: $XDG_CACHE_HOME/spot-detector/results.sqlite, in
+    ~/.cache by default.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")
+    return Path(base).joinpath("spot-detector", "results.sqlite")
+
+
+def default_labels_path() -> Path:
+    """
+    The label maps of the user, see `LabelCache`: next to the results.
+    """
+    return default_cache_path().with_name("labels")
+
+
+def file_hash(path: str | Path) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as file:
+        while chunk := file.read(2**20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    The counts of every image already processed, whatever the csv file or
+    the folder they were written for, in a SQLite database shared by all
+    the campaigns of the user. They are found by the hash of the content of
+    the image and the fingerprints of the configuration: an image that was
+    moved, renamed, or whose csv file was deleted, is not processed again.
+    Every color is stored on its own, under the fingerprint of the palette
+    and of its detection settings (see `ColorAndParams.palette_fingerprint`
+    and `color_fingerprints`): when the settings of a color change, only
+    that color is counted again.
+    The hash of a file is kept with its size and modification time, so that
+    an image is only read once as long as it does not change.
+    """
+
+    batch_size: int = 64  # images per transaction
+    hash_threads: int = 8  # files read at the same time
+
+    def __init__(self, path: str | Path, config: ColorAndParams) -> None:
+        """
+        :param path: The database file, created with its folder if needed.
+        :param config: The configuration of the detector
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.palette = f"{CACHE_VERSION}:{config.palette_fingerprint()}"
+        self.colors = config.color_fingerprints()
+        self.pending: list[tuple[str, str, str, int]] = []
+        self.connection = sqlite3.connect(self.path, timeout=30.0)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def hashes(self, paths: list[str]) -> dict[str, str]:
+        """
+        The hash of the content of every file of `paths` that can be read.
+        Only the files that changed since they were last hashed are read.
+        """
+        known: dict[str, FileHash] = {}
+        for path in paths:
+            row = self.connection.execute(
+                "SELECT size, mtime, hash FROM hashes WHERE path = ?", (path,)
+            ).fetchone()
+            if row is not None:
+                known[path] = row
+
+        def identify(path: str) -> FileHash | None:
+            try:
+                stat = os.stat(path)
+                cached = known.get(path)
+                if cached is not None and cached[:2] == (stat.st_size,
+                                                         stat.st_mtime_ns):
+                    return cached
+                return stat.st_size, stat.st_mtime_ns, file_hash(path)
+            except OSError:
+                return None
+
+        with ThreadPoolExecutor(self.hash_threads) as executor:
+            found = dict(zip(paths, executor.map(identify, paths)))
+        new_rows = [(path, *found_hash) for path, found_hash in found.items()
+                    if found_hash is not None and found_hash != known.get(path)]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO hashes (path, size, mtime, hash)"
+                " VALUES (?, ?, ?, ?)",
+                new_rows,
+            )
+        return {path: found_hash[2] for path, found_hash in found.items()
+                if found_hash is not None}
+
+    def lookup(
+        self,
+        images: list[ImageElement],
+    ) -> tuple[list[DataElement], dict[tuple[int, int], ImageHint]]:
+        """
+        Looks for the counts of `images` in the cache.
+        :return: The results found, and for the other images that could be
+        read, by (row, column), their hash and the counts of the colors
+        already known, None for the others.
+        """
+        paths = [str(Path(path).resolve()) for _, _, path in images]
+        hashes = self.hashes(paths)
+        found: list[DataElement] = []
+        missing: dict[tuple[int, int], ImageHint] = {}
+        for (row, col, _), path in zip(images, paths):
+            if path not in hashes:
+                continue
+            stored = dict(self.connection.execute(
+                "SELECT color, count FROM color_counts"
+                " WHERE image = ? AND palette = ?",
+                (hashes[path], self.palette),
+            ))
+            counts = [stored.get(color) for color in self.colors]
+            if None in counts:
+                missing[(row, col)] = (hashes[path], counts)
+            else:
+                found.append((row, col, counts))
+        return found, missing
+
+    def add(self, image_hash: str, values: list[int]) -> None:
+        for color, value in zip(self.colors, values):
+            self.pending.append((image_hash, self.palette, color, int(value)))
+        if len(self.pending) >= self.batch_size * len(self.colors):
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO color_counts"
+                " (image, palette, color, count) VALUES (?, ?, ?, ?)",
+                self.pending,
+            )
+        self.pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+
+class LabelCache:
+    """
+    The cropped label maps of the images, in a folder, as .npy files named
+    after the hash of the image and the fingerprint of the palette. When
+    only detection settings change, the workers read them, memory-mapped,
+    instead of cropping and labeling the images again.
+    """
+
+    def __init__(self, directory: str | Path, config: ColorAndParams) -> None:
+        """
+        :param directory: The folder of the label maps, created if needed.
+        :param config: The configuration of the detector
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.palette = config.palette_fingerprint()[:16]
+
+    def path(self, image_hash: str) -> Path:
+        return self.directory.joinpath(f"{image_hash}-{self.palette}.npy")
+
+    def load(self, image_hash: str) -> NDArray | None:
+        try:
+            return np.load(self.path(image_hash), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def save(self, image_hash: str, labeled: NDArray) -> None:
+        # written next to the file then renamed, the workers may read it
+        path = self.path(image_hash)
+        tmp_path = path.with_name(f".{path.stem}.{os.getpid()}-{get_ident()}")
+        with open(tmp_path, "wb") as file:
+            np.save(file, labeled)
+        os.replace(tmp_path, path)
@@ -0,0 +1,205 @@
+# Python standard library
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+# Project files
+from .file_utils import fill_data_points, first_two_rows, write_csv
+from .types import DataTable
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    folder TEXT NOT NULL,
+    depth TEXT NOT NULL,
+    color TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (folder, depth, color)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS layout (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class ResultStore:
+    """
+    The results of a detection campaign in a SQLite database, one row per
+    (folder, depth, color). It is an alternative to the journal of the csv
+    file (see `file_utils.append_to_journal`) for large campaigns: results
+    are inserted in batches, in a transaction, and the images left to
+    process are found with a single query on the primary key. The database
+    is in WAL mode, so it can be read while the detection runs.
+    The csv file is exported from the database, with the same layout as
+    `file_utils.fetch_csv`, once the results it already held were imported
+    (see `import_table`). They are only imported once, when the database is
+    created: a campaign is then resumed without reading the results of the
+    csv file.
+    """
+
+    batch_size: int = 64  # images per transaction
+    flush_interval: float = 2.0  # seconds a result may wait for its batch
+
+    def __init__(
+        self,
+        path: str | Path,
+        depths: list[str],
+        colors: list[str],
+    ) -> None:
+        """
+        :param path: The database file, created if it does not exist.
+        :param depths: The depths of the campaign, in the order of the csv.
+        :param colors: The names of the colors, in the order of the csv.
+        :raise FileExistsError: if the database was made for other depths or
+        colors.
+        """
+        self.path = Path(path)
+        self.depths = depths
+        self.colors = colors
+        self.pending: list[tuple[str, str, str, int]] = []
+        self.oldest_pending: float = 0.0
+        self.connection = sqlite3.connect(self.path, timeout=30.0)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+        self.check_layout()
+
+    def check_layout(self) -> None:
+        layout = {"depths": json.dumps(self.depths),
+                  "colors": json.dumps(self.colors)}
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO layout (key, value) VALUES (?, ?)",
+                layout.items(),
+            )
+        stored = dict(self.connection.execute(
+            "SELECT key, value FROM layout WHERE key IN ('depths', 'colors')"
+        ))
+        if stored != layout:
+            raise FileExistsError(
+                f"Les profondeurs ou les couleurs de {self.path.name} "
+                "ne correspondent pas aux paramètres fournis"
+            )
+
+    def add(self, folder: str, depth: str, values: list[int]) -> None:
+        """
+        Adds the counts of every color of an image. They are written with
+        the next batch, when it is full or when they waited long enough.
+        """
+        if not self.pending:
+            self.oldest_pending = time.monotonic()
+        for color, value in zip(self.colors, values):
+            self.pending.append((folder, depth, color, int(value)))
+        if (len(self.pending) >= self.batch_size * len(self.colors)
+                or time.monotonic() - self.oldest_pending > self.flush_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results (folder, depth, color, count)"
+                " VALUES (?, ?, ?, ?)",
+                self.pending,
+            )
+        self.pending.clear()
+
+    def processed(self) -> set[tuple[str, str]]:
+        """
+        The (folder, depth) of the images whose colors were all counted.
+        """
+        self.flush()
+        rows = self.connection.execute(
+            "SELECT folder, depth FROM results"
+            " GROUP BY folder, depth HAVING COUNT(*) = ?",
+            (len(self.colors),),
+        )
+        return set(rows)
+
+    def imported(self) -> bool:
+        """
+        Whether the results of the csv file were imported, see `import_table`.
+        """
+        row = self.connection.execute(
+            "SELECT value FROM layout WHERE key = 'imported'"
+        ).fetchone()
+        return row is not None
+
+    def import_table(self, table: DataTable) -> int:
+        """
+        Adds the results already written in `table`, laid out like the csv
+        file, unless the database has its own for the same image. A campaign
+        started without the database keeps the results of its csv file, and
+        of the images that are no longer on disk, when it is continued with
+        one. The import is recorded, see `imported`.
+        :return: The number of images whose results were in `table`.
+        """
+        depth_count = len(self.depths)
+        rows = []
+        count = 0
+        for row in table[2:]:
+            for col, depth in enumerate(self.depths):
+                cells = [row[1 + col + i * depth_count]
+                         for i in range(len(self.colors))]
+                try:
+                    values = [int(cell) for cell in cells]
+                except (TypeError, ValueError):
+                    continue  # not processed yet
+                count += 1
+                rows += [(str(row[0]), depth, color, value)
+                         for color, value in zip(self.colors, values)]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO results (folder, depth, color, count)"
+                " VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO layout (key, value)"
+                " VALUES ('imported', ?)",
+                (str(count),),
+            )
+        return count
+
+    def fill_table(self, table: DataTable) -> None:
+        """
+        Writes the results of the database in `table`, laid out like the csv
+        file. Folders that are not in the table are ignored.
+        """
+        fname_2_row = {str(row[0]): i for i, row in enumerate(table[2:], 2)}
+        depth_2_col = {depth: i for i, depth in enumerate(self.depths)}
+        color_index = {color: i for i, color in enumerate(self.colors)}
+        counts: dict[tuple[str, str], list[int | None]] = {}
+        rows = self.connection.execute(
+            "SELECT folder, depth, color, count FROM results"
+        )
+        for folder, depth, color, count in rows:
+            default = [None] * len(self.colors)
+            counts.setdefault((folder, depth), default)[color_index[color]] = count
+        for (folder, depth), values in counts.items():
+            if folder not in fname_2_row or depth not in depth_2_col:
+                continue
+            if None in values:
+                continue
+            data_points = (fname_2_row[folder], depth_2_col[depth], values)
+            fill_data_points(table, data_points, len(self.depths),
+                             len(self.colors))
+
+    def export_csv(self, csv_file: str | Path, folders: list[str]) -> None:
+        """
+        Writes the results of `folders` in `csv_file`, with the layout of
+        `file_utils.fetch_csv`. Unprocessed images are left empty.
+        """
+        self.flush()
+        col_count = 1 + (1 + len(self.colors)) * len(self.depths) * 2
+        table: DataTable = list(first_two_rows(self.depths, self.colors))
+        table += [[folder] + [""] * (col_count - 1) for folder in folders]
+        self.fill_table(table)
+        write_csv(csv_file, table)
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
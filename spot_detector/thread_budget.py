@@ -0,0 +1,75 @@
+# Python standard library
+import os
+from collections.abc import Callable
+
+# Other
+import cv2 as cv
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # optional, the BLAS threads are then left as they are
+    threadpool_limits = None
+
+
+def cpu_count() -> int:
+    """
+    The number of cores this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def split_threads(total: int, workers: int) -> tuple[int, int]:
+    """
+    Splits a budget of `total` threads between the workers and the threads
+    of OpenCV and BLAS in each of them. The images are processed
+    independently, so the workers come first: each one gets an equal share
+    of what remains, at least one thread.
+    :param total: The thread budget, usually the number of cores
+    :param workers: The number of workers requested, 0 for one per thread
+    :return: The number of workers and of library threads per worker
+    """
+    total = max(1, total)
+    if workers <= 0:
+        workers = total
+    return workers, max(1, total // workers)
+
+
+def limit_library_threads(count: int) -> Callable[[], None]:
+    """
+    Limits the threads of OpenCV, and of BLAS if threadpoolctl is installed,
+    in the current process. A worker process can keep the limits until it
+    ends, the parent process must restore them.
+    :return: A function restoring the limits found before.
+    """
+    opencv_threads = cv.getNumThreads()
+    cv.setNumThreads(count)
+    blas_limits = None
+    if threadpool_limits is not None:
+        blas_limits = threadpool_limits(limits=count, user_api="blas")
+
+    def restore() -> None:
+        cv.setNumThreads(opencv_threads)
+        if blas_limits is not None:
+            blas_limits.restore_original_limits()
+
+    return restore
+
+
+def describe_threads(
+    workers: int,
+    library_threads: int,
+    total: int,
+    kind: str = "processus",
+) -> str:
+    used = workers * library_threads
+    report = (
+        f"Fils : {workers} {kind} × {library_threads} fils OpenCV/BLAS"
+        f" = {used} pour {total} disponibles."
+    )
+    if used > total:
+        report += " Attention, plus de fils que de cœurs."
+    if threadpool_limits is None:
+        report += " (BLAS non limité : threadpoolctl n'est pas installé.)"
+    return report
@@ -0,0 +1,233 @@
+import time
+
+import cv2 as cv
+from numpy.typing import NDArray
+
+from .config import DetParams, SimpleParam, Threshold
+from .palette_gui import ImageView, reshape_image
+from .process_chains import RICH_KEYPOINTS, DetectionPlan
+
+WINDOW = "tuning tool"
+AREA_LIMIT = 20000  # pixels, the end of the area sliders
+DIST_LIMIT = 200  # pixels, the end of the distance slider
+# slider: (maximum, minimum)
+SLIDERS: dict[str, tuple[int, int]] = {
+    "aire min": (AREA_LIMIT, 0),
+    "aire max": (AREA_LIMIT, 1),
+    "circularite %": (99, 0),
+    "convexite %": (99, 0),
+    "distance min": (DIST_LIMIT, 1),
+    "seuil min": (254, 0),
+    "seuil max": (255, 1),
+    "pas du seuil": (255, 0),
+    "composantes": (1, 0),
+}
+
+
+def run_tuning_gui(
+    plan: DetectionPlan,
+    labeled: NDArray,
+    palette: NDArray,
+    names: list[str],
+) -> list[DetParams] | None:
+    """
+    Shows the spots found in the label map of an image, color by color, and
+    counts them again whenever a slider moves. The image is only labeled
+    once: a change only runs the detection of the color shown.
+    Keys: `a` / `e` previous / next color, space shows the gray image of the
+    color, `_` saves and quits, escape quits without saving. The others move
+    the view, see `ImageView.window_action`.
+    :param plan: The detection plan of the configuration, changed in place
+    :param labeled: The cropped label map of the image
+    :param palette: The BGR shades of the color table
+    :param names: The names of the colors
+    :return: The detection settings of every color, None to discard them.
+    """
+    original = palette[labeled]
+    image_view = ImageView(original.shape)
+    index = 0
+    positions = create_sliders(plan.det_params[index])
+    gray, key_points, elapsed = detect_shown(plan, labeled, index)
+    key = 0
+    while key not in (ord("_"), 27):
+        if key in (ord("a"), ord("e")):
+            step = 1 if key == ord("e") else -1
+            index = (index + step) % len(plan.det_params)
+            positions = load_sliders(plan.det_params[index])
+            gray, key_points, elapsed = detect_shown(plan, labeled, index)
+        elif key != -1:
+            image_view.window_action(key)
+        # a drag moves a slider many times: only its last position is used
+        moved = read_sliders(positions)
+        if moved:
+            settings = plan.det_params[index]
+            for name, value in moved.items():
+                settings = apply_slider(settings, name, value)
+            plan.set_params(index, settings)
+            # a slider can change the others, see `apply_slider`
+            positions = load_sliders(settings)
+            key_points, elapsed = detect_color(plan, labeled, index)
+        if key != -1 or moved:
+            shown_img = gray if image_view.is_alt_img else original
+            shown_img = cv.drawKeypoints(
+                shown_img, key_points, None, [0, 0, 255], RICH_KEYPOINTS  # type: ignore
+            )
+            shown_img = reshape_image(shown_img, image_view)
+            draw_count(shown_img, names[index], len(key_points), elapsed)
+            cv.imshow(WINDOW, shown_img)
+        key = cv.waitKey(50)
+    cv.destroyWindow(WINDOW)
+    if key == 27:
+        return None
+    return plan.det_params
+
+
+def detect_shown(
+    plan: DetectionPlan,
+    labeled: NDArray,
+    i: int,
+) -> tuple[NDArray, list[cv.KeyPoint], float]:
+    gray = cv.cvtColor(cv.LUT(labeled, plan.luts[i]), cv.COLOR_GRAY2BGR)
+    return gray, *detect_color(plan, labeled, i)
+
+
+def detect_color(
+    plan: DetectionPlan,
+    labeled: NDArray,
+    i: int,
+) -> tuple[list[cv.KeyPoint], float]:
+    start = time.perf_counter()
+    key_points = plan.detect_color(labeled, i)
+    return key_points, time.perf_counter() - start
+
+
+def slider_values(settings: DetParams) -> dict[str, int]:
+    """
+    The positions of the sliders for the detection settings of a color.
+    """
+    area = settings.area
+    circ = settings.circ
+    convex = settings.convex
+    area_on = area is not None and area.enabled
+    values = {
+        "aire min": area.mini if area_on else 0,
+        "aire max": (
+            area.maxi if area_on and area.maxi is not None else AREA_LIMIT
+        ),
+        "circularite %": (
+            circ.mini * 100 if circ is not None and circ.enabled else 0
+        ),
+        "convexite %": (
+            convex.mini * 100 if convex is not None and convex.enabled else 0
+        ),
+        "distance min": settings.min_dist or 10,  # the default of openCV
+        "seuil min": settings.thresh.mini,
+        "seuil max": settings.thresh.maxi,
+        "pas du seuil": 0 if settings.thresh.automatic else settings.thresh.step,
+        "composantes": int(settings.engine == "components"),
+    }
+    # a setting out of its slider is shown at its end
+    return {
+        name: min(max(round(value), SLIDERS[name][1]), SLIDERS[name][0])
+        for name, value in values.items()
+    }
+
+
+def apply_slider(settings: DetParams, name: str, value: int) -> DetParams:
+    """
+    The detection settings of a color, with the value of a slider. Only the
+    setting of that slider changes: the others keep their exact value, even
+    when the sliders can not show it.
+    A ratio of 0 disables its filter, a threshold step of 0 means automatic
+    thresholds. Moving a threshold bound turns the automatic thresholds off,
+    and pushes the other bound if they cross.
+    """
+    settings = settings.model_copy(deep=True)
+    area = settings.area
+    if area is None or not area.enabled:
+        area = SimpleParam(enabled=False, mini=0, maxi=None)
+    if name == "aire min":
+        maxi = area.maxi if area.maxi is not None and area.maxi > value else None
+        settings.area = SimpleParam(enabled=True, mini=value, maxi=maxi)
+    elif name == "aire max":
+        mini = min(area.mini, value - 1)
+        settings.area = SimpleParam(enabled=True, mini=mini, maxi=value)
+    elif name in ("circularite %", "convexite %"):
+        field = "circ" if name == "circularite %" else "convex"
+        old = getattr(settings, field)
+        mini = value / 100
+        maxi = None
+        if old is not None and old.maxi is not None and old.maxi > mini:
+            maxi = old.maxi
+        setattr(settings, field, SimpleParam(enabled=value > 0,
+                                             mini=mini, maxi=maxi))
+    elif name == "distance min":
+        settings.min_dist = float(value)
+    elif name in ("seuil min", "seuil max"):
+        thresh = settings.thresh
+        if name == "seuil min":
+            mini, maxi = value, max(thresh.maxi, value + 1)
+        else:
+            mini, maxi = min(thresh.mini, value - 1), value
+        settings.thresh = Threshold(
+            automatic=False,
+            mini=mini,
+            maxi=maxi,
+            step=max(thresh.step, 1),
+            shade_aware=thresh.shade_aware,
+        )
+    elif name == "pas du seuil":
+        thresh = settings.thresh
+        settings.thresh = Threshold(
+            automatic=value == 0,
+            mini=thresh.mini,
+            maxi=thresh.maxi,
+            step=value or thresh.step,
+            shade_aware=thresh.shade_aware,
+        )
+    elif name == "composantes":
+        settings.engine = "components" if value else "blob"
+    return settings
+
+
+def create_sliders(settings: DetParams) -> dict[str, int]:
+    positions = slider_values(settings)
+    cv.namedWindow(WINDOW, cv.WINDOW_NORMAL)
+    for name, (maximum, minimum) in SLIDERS.items():
+        cv.createTrackbar(name, WINDOW, positions[name], maximum, lambda _: None)
+        cv.setTrackbarMin(name, WINDOW, minimum)
+    return positions
+
+
+def load_sliders(settings: DetParams) -> dict[str, int]:
+    positions = slider_values(settings)
+    for name, value in positions.items():
+        cv.setTrackbarPos(name, WINDOW, value)
+    return positions
+
+
+def read_sliders(positions: dict[str, int]) -> dict[str, int]:
+    """
+    The sliders whose position differs from `positions`.
+    """
+    moved = {}
+    for name in SLIDERS:
+        value = cv.getTrackbarPos(name, WINDOW)
+        if value != positions[name]:
+            moved[name] = value
+    return moved
+
+
+def draw_count(img: NDArray, name: str, count: int, elapsed: float) -> None:
+    text = f"{name} : {count} taches ({elapsed * 1000:.0f} ms)"
+    img[:70, :40 + 25 * len(text)] = [127, 127, 127]
+    cv.putText(
+        img,
+        text,
+        (20, 50),
+        cv.FONT_HERSHEY_DUPLEX,
+        1.2,
+        [255, 255, 255],
+        thickness=2,
+    )
+
@@ -5,5 +5,10 @@ Palette:      TypeAlias = list[list[int]]
 DataRow:      TypeAlias = list[Union[int, float, str]]
 DataTable:    TypeAlias = list[DataRow]
 ImageElement: TypeAlias = tuple[int, int, str]
+FolderJob:    TypeAlias = list[ImageElement]
+Batch:        TypeAlias = list[FolderJob]
 DataElement:  TypeAlias = tuple[int, int, list[int]]
+Circle:       TypeAlias = tuple[float, float, float]
+# hash of an image and the counts of its colors already in the cache
+ImageHint:    TypeAlias = tuple[str, list[int | None]]
 T = TypeVar('T')
@@ -0,0 +1,137 @@
+# Standard Python Library
+import tracemalloc
+import unittest
+# Other
+import cv2 as cv
+import numpy as np
+# Project files
+from spot_detector.process_chains import DishGeometry
+from spot_detector.transformations import (
+    circle_roi,
+    dog_error,
+    find_main_circle,
+    fit_circle,
+    mask_to_circle,
+)
+
+
+def synthetic_dish(
+    shape: tuple[int, int],
+    center: tuple[int, int],
+    radius: int,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    A gray background, a dark dish with a bright rim, orange-ish spots
+    and some noise.
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((*shape, 3), 40, dtype=np.uint8)
+    cv.circle(img, center, radius, (17, 1, 3), -1)
+    cv.circle(img, center, radius, (90, 90, 90), 12)
+    for _ in range(500):
+        angle = rng.uniform(0, 2 * np.pi)
+        dist = 0.9 * radius * np.sqrt(rng.uniform())
+        spot = (int(center[0] + dist * np.cos(angle)),
+                int(center[1] + dist * np.sin(angle)))
+        cv.circle(img, spot, int(rng.integers(2, 5)), (134, 191, 253), -1)
+    noise = rng.integers(0, 12, img.shape, dtype=np.uint8)
+    return cv.add(img, noise)
+
+
+class Test_find_main_circle(unittest.TestCase):
+    def test_pyramid_finds_the_dish(self):
+        center, radius = (1520, 990), 650
+        img = synthetic_dish((2000, 3000), center, radius)
+        circle = find_main_circle(img, "pyramid")
+        self.assertIsNotNone(circle)
+        x, y, found_radius = circle
+        self.assertLess(np.hypot(x - center[0], y - center[1]), 3)
+        # the strongest edge is one of the borders of the 12 px rim
+        self.assertLess(abs(found_radius - radius), 8)
+
+    def test_fit_circle(self):
+        angles = np.linspace(0, 2 * np.pi, 50, endpoint=False)
+        x, y, radius = fit_circle(10 + 5 * np.cos(angles),
+                                  -3 + 5 * np.sin(angles))
+        self.assertAlmostEqual(x, 10)
+        self.assertAlmostEqual(y, -3)
+        self.assertAlmostEqual(radius, 5)
+
+
+def float_mask_to_circle(src: np.ndarray, circle) -> np.ndarray:
+    """
+    The float64 masking that crop_to_main_circle used before circle_roi.
+    """
+    x, y, radius = circle
+    radius = round(radius * 1.05)
+    x = round(x)
+    y = round(y)
+    left = max(0, x - radius)
+    right = min(x + radius, src.shape[1] - 1)
+    top = max(0, y - radius)
+    bottom = min(y + radius, src.shape[0] - 1)
+    offset = np.ndarray(shape=(2, 1, 1))
+    offset[:, 0, 0] = (min(radius, y), min(radius, x))
+    coords = np.indices((bottom - top, right - left)) - offset
+    mask = (coords ** 2).sum(axis=0) <= radius**2
+    return src[top:bottom, left:right, :] * mask[:, :, None]
+
+
+class Test_circle_roi(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.img = rng.integers(1, 256, (300, 400, 3), dtype=np.uint8)
+
+    def test_same_pixels_as_float_mask(self):
+        circles = [(200.4, 150.6, 90.3), (30.0, 40.0, 100.0),
+                   (390.0, 280.0, 60.0), (200.0, 150.0, 300.0)]
+        for circle in circles:
+            with self.subTest(circle=circle):
+                np.testing.assert_array_equal(
+                    mask_to_circle(self.img, circle),
+                    float_mask_to_circle(self.img, circle),
+                )
+
+    def test_roi_is_a_view(self):
+        roi, outside = circle_roi(self.img, (200.0, 150.0, 90.0))
+        self.assertTrue(np.shares_memory(roi, self.img))
+        self.assertEqual(outside.dtype, np.uint8)
+        self.assertEqual(outside.shape, roi.shape[0:2])
+
+    def test_only_the_mask_is_allocated(self):
+        tracemalloc.start()
+        roi, _ = circle_roi(self.img, (200.0, 150.0, 90.0))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertLess(peak, roi.shape[0] * roi.shape[1] + 2**12)
+
+
+class Test_diff_of_gaussian_fast(unittest.TestCase):
+    def test_error_bound(self):
+        img = synthetic_dish((2000, 3000), (1520, 990), 650)
+        mean, p99, _ = dog_error(img[:, :, 0], 10, 50)
+        self.assertLess(mean, 1.0)
+        self.assertLessEqual(p99, 8)
+
+
+class Test_DishGeometry(unittest.TestCase):
+    def test_reuses_the_circle_of_the_same_position(self):
+        geometry = DishGeometry("pyramid")
+        first = geometry.locate(synthetic_dish((2000, 3000), (1520, 990), 650))
+        second = geometry.locate(
+            synthetic_dish((2000, 3000), (1520, 990), 650, seed=1)
+        )
+        self.assertEqual(geometry.searches, 1)
+        self.assertEqual(first, second)
+
+    def test_searches_again_when_the_dish_moved(self):
+        geometry = DishGeometry("pyramid")
+        geometry.locate(synthetic_dish((2000, 3000), (1520, 990), 650))
+        circle = geometry.locate(synthetic_dish((2000, 3000), (1300, 1100), 650))
+        self.assertEqual(geometry.searches, 2)
+        self.assertLess(np.hypot(circle[0] - 1300, circle[1] - 1100), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+# Standard Python Library
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+# Other
+import cv2 as cv
+import numpy as np
+import tomlkit
+# Project files
+from spot_detector.config import ColorAndParams, DetParams
+from spot_detector.detection import (
+    blob_thresholds,
+    detect_components,
+    engine_agreement,
+    shade_aware_params,
+)
+from spot_detector.process_chains import DetectionPlan
+from spot_detector.result_cache import LabelCache
+from spot_detector.transformations import (
+    category_luts,
+    evenly_spaced_gray_palette,
+    gray_luts,
+    isolate_categories,
+    label_img_fastest,
+)
+
+
+def load_color_table() -> np.ndarray:
+    path = Path(__file__).parent.joinpath("color_and_detection.toml")
+    with open(path, "r", encoding="UTF-8") as file:
+        content = tomlkit.load(file)
+    return np.array(content["color_data"]["table"])
+
+
+class Test_gray_luts(unittest.TestCase):
+    def setUp(self):
+        self.color_table = load_color_table()
+        rng = np.random.default_rng(11)
+        shades = len(self.color_table)
+        self.labeled = rng.integers(0, shades, (80, 70), dtype=np.uint8)
+
+    def test_matches_per_color_gather(self):
+        det_params = [DetParams.from_prepopulated_defaults(name)
+                      for name in ("orange", "vert")]
+        plan = DetectionPlan(self.color_table, det_params)
+        np.testing.assert_array_equal(plan.luts, gray_luts(self.color_table, 2))
+        for i, lut in enumerate(plan.luts):
+            isolated_color = isolate_categories(self.color_table, [i + 1])
+            gs_palette = evenly_spaced_gray_palette(isolated_color)
+            expected = gs_palette[self.labeled.flatten()]
+            expected = expected.reshape(self.labeled.shape).astype(np.uint8)
+            np.testing.assert_array_equal(cv.LUT(self.labeled, lut), expected)
+            params = det_params[i].load_params(len(self.color_table))
+            detector = cv.SimpleBlobDetector.create(params)
+            self.assertEqual(len(plan.detect_color(self.labeled, i)),
+                             len(detector.detect(expected)))
+
+
+def synthetic_plate(color_table: np.ndarray, seed: int) -> np.ndarray:
+    """
+    A dark image with spots of the shades of color 1 and color 2.
+    """
+    rng = np.random.default_rng(seed)
+    img = np.zeros((400, 500, 3), dtype=np.uint8)
+    img[:] = color_table[5, 0:3]
+    for shade, count in ((6, 60), (13, 40)):
+        color = [int(v) for v in color_table[shade, 0:3]]
+        for _ in range(count):
+            x, y = rng.integers(10, 490), rng.integers(10, 390)
+            radius = int(rng.integers(2, 6))
+            cv.circle(img, (int(x), int(y)), radius, color, -1)
+    return img
+
+
+class Test_detect_components(unittest.TestCase):
+    def setUp(self):
+        self.color_table = load_color_table()
+        img = synthetic_plate(self.color_table, 5)
+        labeled = label_img_fastest(img, self.color_table)
+        self.gs_images = [cv.LUT(labeled, lut)
+                          for lut in gray_luts(self.color_table, 2)]
+        self.masks = [cv.LUT(labeled, lut)
+                      for lut in category_luts(self.color_table, 2)]
+
+    def test_agrees_with_blob_detector(self):
+        for i, name in enumerate(["orange", "vert"]):
+            settings = DetParams.from_prepopulated_defaults(name)
+            params = settings.load_params(len(self.color_table))
+            blob_count, component_count = engine_agreement(
+                self.gs_images[i], self.masks[i], params
+            )
+            self.assertGreater(blob_count, 0)
+            self.assertEqual(component_count, blob_count)
+
+    def test_min_dist_merges_close_spots(self):
+        mask = np.zeros((50, 50), dtype=np.uint8)
+        cv.circle(mask, (10, 10), 3, 255, -1)
+        cv.circle(mask, (19, 10), 3, 255, -1)
+        cv.circle(mask, (40, 40), 3, 255, -1)
+        settings = DetParams.from_prepopulated_defaults("orange")
+        params = settings.load_params(20)
+        params.minDistBetweenBlobs = 1.0
+        self.assertEqual(len(detect_components(mask, params)), 3)
+        params.minDistBetweenBlobs = 12.0
+        self.assertEqual(len(detect_components(mask, params)), 2)
+
+
+class Test_DetectionPlan(unittest.TestCase):
+    def setUp(self):
+        self.color_table = load_color_table()
+        self.det_params = [DetParams.from_prepopulated_defaults(name)
+                           for name in ("orange", "vert")]
+        self.plan = DetectionPlan(self.color_table, self.det_params)
+
+    def expected_counts(self, img):
+        labeled = label_img_fastest(img, self.color_table)
+        gs_images = [cv.LUT(labeled, lut)
+                     for lut in gray_luts(self.color_table, 2)]
+        counts = []
+        for settings, gs_img in zip(self.det_params, gs_images):
+            params = settings.load_params(len(self.color_table))
+            detector = cv.SimpleBlobDetector.create(params)
+            counts.append(len(detector.detect(gs_img)))
+        return counts
+
+    def test_reused_plan_counts_every_image(self):
+        copy = self.plan.copy()
+        self.assertIsNot(copy.detectors[0], self.plan.detectors[0])
+        self.assertIs(copy.luts, self.plan.luts)
+        for seed in range(3):
+            img = synthetic_plate(self.color_table, seed)
+            expected = self.expected_counts(img)
+            with self.subTest(seed=seed):
+                self.assertEqual(self.plan.count_spots(img, lambda _: None),
+                                 expected)
+                self.assertEqual(copy.count_spots(img, lambda _: None),
+                                 expected)
+
+    def test_set_params_rebuilds_a_single_color(self):
+        img = synthetic_plate(self.color_table, 1)
+        _, labeled = self.plan.label(img, lambda _: None)
+        kept = self.plan.detectors[0]
+        settings = self.det_params[1].model_copy(deep=True)
+        settings.engine = "components"
+        settings.area.mini = 30.0
+        self.plan.set_params(1, settings)
+        self.assertIs(self.plan.detectors[0], kept)
+        self.assertIsNone(self.plan.detectors[1])
+        self.assertEqual(self.det_params[1].engine, "blob")
+        fresh = DetectionPlan(self.color_table, [self.det_params[0], settings])
+        self.assertEqual(self.plan.count_labels(labeled),
+                         fresh.count_labels(labeled))
+
+    def test_cached_label_maps_skip_the_labeling(self):
+        img = synthetic_plate(self.color_table, 0)
+        expected = self.expected_counts(img)
+        config = ColorAndParams.from_defaults()
+        with TemporaryDirectory() as tmp_dir:
+            labels = LabelCache(tmp_dir, config)
+            plan = DetectionPlan(self.color_table, self.det_params,
+                                 labels=labels)
+            hint = ("0123", [None, None])
+            counts = plan.count_image(lambda: img, lambda _: None, hint)
+            self.assertEqual(counts, expected)
+            self.assertTrue(labels.path("0123").is_file())
+            # the label map is read, not the image
+            counts = plan.count_image(lambda: None, lambda _: None, hint)
+            self.assertEqual(counts, expected)
+            counts = plan.count_image(lambda: None, lambda _: None,
+                                      ("0123", [-1, None]))
+            self.assertEqual(counts, [-1, expected[1]])
+            self.assertIsNone(
+                plan.count_image(lambda: None, lambda _: None, ("4567", [None]))
+            )
+
+
+class Test_shade_aware_params(unittest.TestCase):
+    def setUp(self):
+        self.color_table = load_color_table()
+        rng = np.random.default_rng(8)
+        img = synthetic_plate(self.color_table, 8)
+        # spots of color 1 with a brighter core, so that several masks differ
+        for _ in range(40):
+            x, y = int(rng.integers(10, 490)), int(rng.integers(10, 390))
+            cv.circle(img, (x, y), 5, [int(v) for v in self.color_table[2, 0:3]], -1)
+            cv.circle(img, (x, y), 2, [int(v) for v in self.color_table[6, 0:3]], -1)
+        labeled = label_img_fastest(img, self.color_table)
+        self.luts = gray_luts(self.color_table, 2)
+        self.gs_images = [cv.LUT(labeled, lut) for lut in self.luts]
+
+    def test_same_counts_with_fewer_binarizations(self):
+        shades = len(self.color_table)
+        for i, name in enumerate(["orange", "vert"]):
+            params = DetParams.from_prepopulated_defaults(name).load_params(shades)
+            new_params, saved = shade_aware_params(params, self.luts[i, :shades])
+            self.assertGreater(saved, 0)
+            self.assertEqual(
+                len(blob_thresholds(new_params)) + saved,
+                len(blob_thresholds(params)),
+            )
+            expected = cv.SimpleBlobDetector.create(params).detect(self.gs_images[i])
+            found = cv.SimpleBlobDetector.create(new_params).detect(self.gs_images[i])
+            self.assertEqual(len(found), len(expected))
+
+    def test_keeps_params_when_a_mask_is_seen_once(self):
+        params = DetParams.from_prepopulated_defaults("orange").load_params(20)
+        params.minThreshold, params.maxThreshold = 10, 250
+        params.thresholdStep = 100
+        levels = np.array([0, 64, 128, 192, 255], dtype=np.uint8)
+        new_params, saved = shade_aware_params(params, levels)
+        self.assertIs(new_params, params)
+        self.assertEqual(saved, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
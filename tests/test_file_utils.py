@@ -0,0 +1,236 @@
+# Standard Python Library
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+# Other
+import cv2 as cv
+import numpy as np
+# Project files
+from spot_detector.core import longest_first
+from spot_detector.file_utils import (
+    ImageIndex,
+    append_to_journal,
+    check_img_count,
+    checkpoint,
+    fetch_csv,
+    fill_data_points,
+    image_pixels,
+    image_size,
+    journal_path,
+    load_results,
+    manifest_path,
+    match_dir_items,
+    open_journal,
+    quarantine_path,
+    read_csv,
+    read_durations,
+    read_quarantine,
+    write_durations,
+    write_quarantine,
+)
+
+
+class Test_journal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        root = Path(self.tmp_dir.name)
+        self.sub_dirs = []
+        for name in ("a", "b"):
+            root.joinpath(name).mkdir()
+            self.sub_dirs.append(root.joinpath(name))
+        self.depths = ["0.0", "0.5"]
+        self.colors = ["orange", "vert"]
+        self.csv_file = fetch_csv(
+            root.joinpath("out.csv"), self.depths, self.colors, self.sub_dirs
+        )
+        self.results = [(2, 0, [3, 4]), (2, 1, [1, 0]), (3, 1, [0, 7])]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def expected_table(self):
+        table = read_csv(self.csv_file)
+        for data_points in self.results:
+            fill_data_points(table, data_points, 2, 2)
+        return table
+
+    def journal_results(self):
+        table = read_csv(self.csv_file)
+        with open(journal_path(self.csv_file), "a", newline="") as journal:
+            for data_points in self.results:
+                append_to_journal(journal, table, data_points, self.depths)
+
+    def test_replay_matches_direct_filling(self):
+        self.journal_results()
+        table = load_results(self.csv_file, self.depths, self.colors)
+        self.assertEqual(table, self.expected_table())
+
+    def test_truncated_line_is_ignored(self):
+        self.journal_results()
+        with open(journal_path(self.csv_file), "a") as journal:
+            journal.write("b,0.0,5")
+        table = load_results(self.csv_file, self.depths, self.colors)
+        self.assertEqual(table, self.expected_table())
+
+    def test_result_after_a_truncated_line_is_kept(self):
+        with open(journal_path(self.csv_file), "a") as journal:
+            journal.write("b,0.0,5")
+        table = read_csv(self.csv_file)
+        with open_journal(self.csv_file) as journal:
+            for data_points in self.results:
+                append_to_journal(journal, table, data_points, self.depths)
+        table = load_results(self.csv_file, self.depths, self.colors)
+        self.assertEqual(table, self.expected_table())
+
+    def test_folder_names_with_commas_and_quotes(self):
+        root = Path(self.tmp_dir.name)
+        root.joinpath('a,"b').mkdir()
+        self.sub_dirs.append(root.joinpath('a,"b'))
+        self.csv_file = fetch_csv(
+            root.joinpath("other.csv"), self.depths, self.colors, self.sub_dirs
+        )
+        self.results.append((4, 0, [2, 9]))
+        self.journal_results()
+        table = load_results(self.csv_file, self.depths, self.colors)
+        self.assertEqual(table, self.expected_table())
+
+    def test_quarantine_is_read_back_and_removed_when_empty(self):
+        self.assertEqual(read_quarantine(self.csv_file), {})
+        images = [("a/img 0.0.jpg", "plus de 600 s sur une image")]
+        path = write_quarantine(self.csv_file, images)
+        self.assertEqual(path, quarantine_path(self.csv_file))
+        self.assertEqual(read_quarantine(self.csv_file), dict(images))
+        write_quarantine(self.csv_file, [])
+        self.assertFalse(path.exists())
+
+    def test_checkpoint_empties_the_journal(self):
+        self.journal_results()
+        table = load_results(self.csv_file, self.depths, self.colors)
+        checkpoint(self.csv_file, table)
+        self.assertEqual(journal_path(self.csv_file).stat().st_size, 0)
+        self.assertEqual(
+            load_results(self.csv_file, self.depths, self.colors),
+            read_csv(self.csv_file),
+        )
+        files = sorted(p.name for p in Path(self.tmp_dir.name).iterdir())
+        self.assertEqual(files, ["a", "b", "out.csv", "out.csv.journal"])
+
+
+class Test_image_size(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_header_sizes(self):
+        img = np.zeros((30, 50, 3), dtype=np.uint8)
+        for name in ("img.png", "img.jpg"):
+            path = self.root.joinpath(name)
+            cv.imwrite(str(path), img)
+            with self.subTest(name=name):
+                self.assertEqual(image_size(path), (30, 50))
+                self.assertEqual(image_pixels(path), 1500)
+
+    def test_unknown_format_and_missing_file(self):
+        path = self.root.joinpath("img.raw")
+        path.write_bytes(bytes(300))
+        self.assertIsNone(image_size(path))
+        self.assertEqual(image_pixels(path), 100)
+        self.assertEqual(image_pixels(self.root.joinpath("missing.png")), 0)
+
+
+class Test_longest_first(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.jobs = []
+        for row, (name, shape) in enumerate([("a", (30, 50)), ("b", (60, 50)),
+                                             ("c", (30, 50))]):
+            self.root.joinpath(name).mkdir()
+            path = self.root.joinpath(name, "img.png")
+            cv.imwrite(str(path), np.zeros((*shape, 3), dtype=np.uint8))
+            self.jobs.append([(row, 0, str(path))])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_pixels_without_history(self):
+        self.assertEqual(longest_first(self.jobs),
+                         [self.jobs[1], self.jobs[0], self.jobs[2]])
+
+    def test_durations_of_the_previous_runs(self):
+        csv_file = self.root.joinpath("out.csv")
+        self.assertEqual(read_durations(csv_file), {})
+        write_durations(csv_file, {"a": 0.1, "b": 2.9, "c": 5.0})
+        history = read_durations(csv_file)
+        self.assertEqual(longest_first(self.jobs, history),
+                         [self.jobs[2], self.jobs[1], self.jobs[0]])
+        # a folder without history, at the speed of the known ones: 1 s
+        del history["c"]
+        self.assertEqual(longest_first(self.jobs, history),
+                         [self.jobs[1], self.jobs[2], self.jobs[0]])
+
+
+class Test_ImageIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.depths = ["1", "10", "0.5"]
+        names = {
+            "b": ["img 1.jpg", "img 10.jpg", "img 0.5.jpg", "notes.txt"],
+            "a": ["img 1.jpg", "img 0x5.jpg", "img 10.png", "other 10.jpg"],
+        }
+        for folder, files in names.items():
+            self.root.joinpath(folder).mkdir()
+            for name in files:
+                self.root.joinpath(folder, name).touch()
+        self.root.joinpath("a", "img 0.5.jpg").mkdir()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_same_matches_as_one_listing_per_depth(self):
+        regex = r"img $value\.(jpg|png)"
+        index = ImageIndex(self.root, regex, self.depths, threads=2)
+        self.assertEqual([d.name for d in index.sub_dirs], ["a", "b"])
+        for sub_dir in index.sub_dirs:
+            for depth in self.depths:
+                with self.subTest(folder=sub_dir.name, depth=depth):
+                    self.assertEqual(
+                        sorted(index.images(sub_dir, depth)),
+                        sorted(match_dir_items(sub_dir, regex, depth)),
+                    )
+        self.assertEqual(check_img_count(3, index), (1, [4, 3]))
+
+    def test_manifest_skips_unchanged_folders(self):
+        regex = r"img $value\.(jpg|png)"
+        manifest = manifest_path(self.root.joinpath("out.csv"))
+        for sub_dir in self.root.iterdir():
+            # older than the delay after which a folder is trusted
+            os.utime(sub_dir, (1e9, 1e9))
+        first = ImageIndex(self.root, regex, self.depths, manifest=manifest)
+        second = ImageIndex(self.root, regex, self.depths, manifest=manifest)
+        self.assertEqual((first.rescanned, second.rescanned), (2, 0))
+        self.assertEqual(second.scans, first.scans)
+        self.root.joinpath("a", "img 10.jpg").touch()
+        third = ImageIndex(self.root, regex, self.depths, manifest=manifest)
+        a = self.root.joinpath("a")
+        self.assertEqual(third.rescanned, 1)
+        self.assertEqual(sorted(third.images(a, "10")),
+                         [a.joinpath("img 10.jpg"), a.joinpath("img 10.png")])
+        other = ImageIndex(self.root, "other $value.jpg", self.depths,
+                           manifest=manifest)
+        self.assertEqual(other.rescanned, 2)
+
+    def test_regex_without_depth(self):
+        index = ImageIndex(self.root, r"other 10\.jpg", self.depths)
+        a = self.root.joinpath("a")
+        for depth in self.depths:
+            self.assertEqual(index.images(a, depth), [a.joinpath("other 10.jpg")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# Standard Python Library
+from contextlib import redirect_stdout
+from io import StringIO
+import tracemalloc
+import unittest
+from typing import get_args
+# Other
+import numpy as np
+# Project files
+from spot_detector.config import LabelingParams
+from spot_detector.process_chains import get_labeler
+from spot_detector.transformations import (
+    build_color_cube_lut,
+    label_img_fastest,
+    label_img_lut,
+    label_img_tiled,
+)
+
+
+class Test_label_img_lut(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.img = rng.integers(0, 256, (120, 90, 3), dtype=np.uint8)
+        self.color_table = rng.integers(0, 256, (20, 4))
+        self.color_table[:, 3] = rng.integers(0, 3, 20)
+
+    def test_full_depth_matches_fastest(self):
+        lut = build_color_cube_lut(self.color_table, 8)
+        expected = label_img_fastest(self.img, self.color_table)
+        labeled = label_img_lut(self.img, lut)
+        self.assertEqual(labeled.dtype, np.uint8)
+        self.assertEqual(labeled.shape, self.img.shape[0:2])
+        np.testing.assert_array_equal(labeled, expected)
+
+    def test_reduced_depth_labels_bin_centers(self):
+        bits = 5
+        lut = build_color_cube_lut(self.color_table, bits)
+        shift = 8 - bits
+        centers = (self.img >> shift << shift) + (1 << shift >> 1)
+        expected = label_img_fastest(centers, self.color_table)
+        np.testing.assert_array_equal(label_img_lut(self.img, lut), expected)
+
+    def test_invalid_depth(self):
+        with self.assertRaises(ValueError):
+            build_color_cube_lut(self.color_table, 0)
+
+
+class Test_label_img_tiled(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.img = rng.integers(0, 256, (301, 200, 3), dtype=np.uint8)
+        self.color_table = rng.integers(0, 256, (20, 4))
+
+    def test_matches_fastest(self):
+        expected = label_img_fastest(self.img, self.color_table)
+        for budget in (1, 2**20, 2**30):
+            labeled = label_img_tiled(self.img, self.color_table, budget)
+            self.assertEqual(labeled.dtype, np.uint8)
+            np.testing.assert_array_equal(labeled, expected)
+
+    def test_peak_memory_is_bounded(self):
+        budget = 2**20
+        tracemalloc.start()
+        label_img_tiled(self.img, self.color_table, budget)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        output_size = self.img.shape[0] * self.img.shape[1]
+        self.assertLessEqual(peak, budget + output_size + 2**16)
+
+
+class Test_get_labeler(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.img = rng.integers(0, 256, (64, 48, 3), dtype=np.uint8)
+        # a few duplicated shades to check that ties are broken alike
+        self.color_table = rng.integers(0, 256, (16, 4))
+        self.color_table[8:12] = self.color_table[0:4]
+
+    def test_all_engines_give_identical_labels(self):
+        expected = label_img_fastest(self.img, self.color_table)
+        engines = get_args(LabelingParams.model_fields["engine"].annotation)
+        for engine in engines:
+            settings = LabelingParams(engine=engine, lut_bits=8, budget_mb=1)
+            labeler = get_labeler(self.color_table, settings)
+            with redirect_stdout(StringIO()):
+                labeled = labeler(self.img)
+            with self.subTest(engine=engine):
+                self.assertEqual(labeled.dtype, np.uint8)
+                np.testing.assert_array_equal(labeled, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
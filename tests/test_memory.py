@@ -0,0 +1,102 @@
+# Standard Python Library
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import tracemalloc
+import unittest
+# Other
+import cv2 as cv
+import numpy as np
+# Project files
+from spot_detector.config import ColorAndParams, LabelingParams
+from spot_detector.memory import (
+    MemoryBudget,
+    image_peak_memory,
+    labeler_bytes_per_pixel,
+)
+from spot_detector.process_chains import WorkerPool, get_labeler
+
+
+class Test_image_peak_memory(unittest.TestCase):
+    def test_bounds_the_numpy_allocations_of_the_labelers(self):
+        rng = np.random.default_rng(4)
+        img = rng.integers(0, 256, (200, 300, 3), dtype=np.uint8)
+        color_table = rng.integers(0, 256, (20, 4))
+        for engine in ("fastest", "lut", "tiled", "blas"):
+            settings = LabelingParams(engine=engine, budget_mb=1)
+            labeler = get_labeler(color_table, settings)
+            tracemalloc.start()
+            labeler(img)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            estimate = labeler_bytes_per_pixel(settings, 20) * 200 * 300
+            with self.subTest(engine=engine):
+                self.assertLessEqual(peak, estimate + 2**16)
+
+    def test_grows_with_resolution_and_palette(self):
+        config = ColorAndParams.from_defaults()
+        small = image_peak_memory((1000, 1500), config)
+        self.assertGreater(image_peak_memory((2000, 3000), config), small)
+        config.color_data.table = config.color_data.table * 10
+        self.assertGreater(image_peak_memory((1000, 1500), config), small)
+
+
+class Test_MemoryBudget(unittest.TestCase):
+    def setUp(self):
+        self.config = ColorAndParams.from_defaults()
+        self.tmp_dir = TemporaryDirectory()
+        self.paths = []
+        for shape in ((100, 100), (400, 600)):
+            path = Path(self.tmp_dir.name).joinpath(f"{shape[0]}.png")
+            cv.imwrite(str(path), np.zeros((*shape, 3), dtype=np.uint8))
+            self.paths.append(str(path))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_job_memory_reads_the_headers(self):
+        budget = MemoryBudget(2**30, self.config)
+        job = [(0, 0, self.paths[0]), (0, 1, self.paths[1])]
+        expected = image_peak_memory((400, 600), self.config)
+        self.assertEqual(budget.job_memory(job), expected)
+
+    def test_admission(self):
+        budget = MemoryBudget(100, self.config)
+        budget.available = 100
+        self.assertTrue(budget.fits(1000))  # alone, even if too large
+        budget.take(60)
+        self.assertTrue(budget.fits(40))
+        self.assertFalse(budget.fits(41))
+        budget.give(60)
+        self.assertTrue(budget.fits(1000))
+
+    def test_workers_are_limited_by_the_budget(self):
+        budget = MemoryBudget(2**30, self.config)
+        with redirect_stdout(StringIO()):
+            self.assertEqual(budget.reserve_workers(16, 2**20), 6)
+            self.assertEqual(budget.reserve_workers(2, 2**20), 2)
+            self.assertEqual(budget.reserve_workers(4, 2**31), 1)
+
+    def test_first_batch_is_only_overtaken_a_few_times(self):
+        budget = MemoryBudget(2**30, self.config)
+        small = budget.job_memory([(0, 0, self.paths[0])])
+        large = budget.job_memory([(0, 0, self.paths[1])])
+        budget.available = large
+        budget.take(small)  # a small batch is running
+        pool = WorkerPool(2, self.config, memory=budget)
+        pool.lookahead = 3
+        pool.pending.append((0, [[(0, 0, self.paths[1])]]))
+        for batch_id in range(1, 10):
+            pool.pending.append((batch_id, [[(batch_id, 0, self.paths[0])]]))
+        sent = []
+        while (chosen := pool.next_batch()) is not None:
+            sent.append(chosen[0])
+            budget.give(small)
+        self.assertEqual(sent, [1, 2, 3])
+        budget.give(small)
+        self.assertEqual(pool.next_batch()[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+# Standard Python Library
+from contextlib import redirect_stdout
+from io import StringIO
+from multiprocessing import Pipe, Process
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+# Other
+import cv2 as cv
+import numpy as np
+# Project files
+from spot_detector.config import ColorAndParams
+from spot_detector.process_chains import ThreadWorkerPool, WorkerPool
+from spot_detector.result_cache import LabelCache, file_hash
+from spot_detector.thread_budget import limit_library_threads, split_threads
+
+
+def exit_at_once() -> None:
+    os._exit(3)
+
+
+class StillbornPool(WorkerPool):
+    """
+    A pool whose workers die before they start an image.
+    """
+
+    def spawn_worker(self, worker_id):
+        receiver, sender = Pipe(duplex=False)
+        worker = Process(target=exit_at_once, daemon=True)
+        worker.start()
+        sender.close()
+        return worker, receiver
+
+
+class Test_WorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.config = ColorAndParams.from_defaults()
+        self.config.crop.mode = "pyramid"
+        self.tmp_dir = TemporaryDirectory()
+        img = np.full((600, 800, 3), 40, dtype=np.uint8)
+        cv.circle(img, (400, 300), 200, (17, 1, 3), -1)
+        cv.circle(img, (400, 300), 200, (90, 90, 90), 8)
+        cv.circle(img, (400, 300), 20, (255, 255, 255), -1)
+        self.path = str(Path(self.tmp_dir.name).joinpath("img.png"))
+        cv.imwrite(self.path, img)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_batches_cover_every_job(self):
+        pool = WorkerPool(3, self.config, max_batch=4)
+        jobs = [[(i, 0, str(i))] for i in range(50)]
+        batches = pool.make_batches(jobs)
+        self.assertEqual([job for batch in batches for job in batch], jobs)
+        self.assertTrue(all(1 <= len(batch) <= 4 for batch in batches))
+        sizes = [len(batch) for batch in batches]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual((sizes[0], sizes[-1]), (4, 1))
+
+    def test_results_and_failures(self):
+        missing = str(Path(self.tmp_dir.name).joinpath("missing.png"))
+        jobs = [[(i, 0, self.path)] for i in range(5)] + [[(5, 0, missing)]]
+        for decoders in (0, 1):
+            output = StringIO()
+            with redirect_stdout(output):
+                pool = WorkerPool(2, self.config, decoders=decoders)
+                results = list(pool.run(jobs))
+            with self.subTest(decoders=decoders):
+                rows = sorted(row for row, _, _ in results)
+                self.assertEqual(rows, list(range(5)))
+                self.assertEqual(
+                    len({tuple(values) for _, _, values in results}), 1
+                )
+                self.assertIn(missing, output.getvalue())
+
+    def test_decoders_give_the_same_results(self):
+        jobs = [[(0, i, self.path) for i in range(3)], [(1, 0, self.path)]]
+        expected = sorted(WorkerPool(2, self.config).run(jobs))
+        results = sorted(WorkerPool(2, self.config, decoders=1).run(jobs))
+        self.assertEqual(results, expected)
+
+    def test_decoders_skip_the_images_with_a_label_map(self):
+        copy = self.path + ".copy.png"
+        Path(copy).write_bytes(Path(self.path).read_bytes())
+        jobs = [[(0, 0, self.path)], [(1, 0, copy)]]
+        labels = LabelCache(Path(self.tmp_dir.name).joinpath("labels"),
+                            self.config)
+        pool = WorkerPool(1, self.config, decoders=1, labels=labels)
+        image_hash = file_hash(copy)
+        expected = sorted(pool.run(jobs, hints={(1, 0): (image_hash, [None])}))
+        self.assertTrue(labels.path(image_hash).is_file())
+        # the copy is gone, only its label map can give its counts
+        os.remove(copy)
+        pool = WorkerPool(1, self.config, decoders=1, labels=labels)
+        results = sorted(pool.run(jobs, hints={(1, 0): (image_hash, [None])}))
+        self.assertEqual(results, expected)
+
+    def test_threads_give_the_same_results(self):
+        missing = str(Path(self.tmp_dir.name).joinpath("missing.png"))
+        jobs = [[(0, i, self.path) for i in range(3)], [(1, 0, missing)]]
+        with redirect_stdout(StringIO()):
+            expected = sorted(WorkerPool(2, self.config).run(jobs))
+            results = sorted(ThreadWorkerPool(2, self.config).run(jobs))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results, expected)
+
+    def test_killed_worker_is_replaced(self):
+        jobs = [[(i, 0, self.path)] for i in range(6)]
+        for decoders in (0, 1):
+            pool = WorkerPool(2, self.config, decoders=decoders)
+            results = []
+            with redirect_stdout(StringIO()):
+                for result in pool.run(jobs):
+                    if not results:
+                        pool.workers[0].kill()
+                        pool.workers[1].kill()
+                    results.append(result)
+            with self.subTest(decoders=decoders):
+                rows = sorted(row for row, _, _ in results)
+                self.assertEqual(rows, list(range(6)))
+                self.assertEqual(pool.quarantined, [])
+
+    def test_images_over_the_timeout_are_quarantined(self):
+        jobs = [[(0, 0, self.path), (0, 1, self.path)], [(1, 0, self.path)]]
+        pool = WorkerPool(2, self.config, image_timeout=0.0, max_attempts=2)
+        output = StringIO()
+        with redirect_stdout(output):
+            results = list(pool.run(jobs))
+        self.assertEqual(results, [])
+        self.assertEqual(len(pool.quarantined), 3)
+        self.assertIn("nouvel essai", output.getvalue())
+
+    def test_workers_dying_before_any_image_stop_the_pool(self):
+        jobs = [[(i, 0, self.path)] for i in range(4)]
+        pool = StillbornPool(2, self.config, max_attempts=3)
+        with redirect_stdout(StringIO()):
+            with self.assertRaisesRegex(RuntimeError, "3 fois"):
+                list(pool.run(jobs))
+
+    def test_nothing_to_do(self):
+        pool = WorkerPool(2, self.config)
+        self.assertEqual(list(pool.run([])), [])
+        self.assertEqual(pool.workers, [])
+
+
+class Test_split_threads(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_threads(32, 1), (1, 32))
+        self.assertEqual(split_threads(32, 8), (8, 4))
+        self.assertEqual(split_threads(32, 5), (5, 6))
+        self.assertEqual(split_threads(32, 0), (32, 1))
+        self.assertEqual(split_threads(4, 8), (8, 1))
+
+    def test_limits_are_restored(self):
+        before = cv.getNumThreads()
+        restore = limit_library_threads(before + 1)
+        self.assertEqual(cv.getNumThreads(), before + 1)
+        restore()
+        self.assertEqual(cv.getNumThreads(), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+# Standard Python Library
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+# Project files
+from spot_detector.config import ColorAndParams
+from spot_detector.result_cache import ResultCache
+
+
+class Test_ResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.config = ColorAndParams.from_defaults()
+        self.db = self.root.joinpath("cache", "results.sqlite")
+        self.paths = []
+        for name in ("a.jpg", "b.jpg"):
+            path = self.root.joinpath(name)
+            path.write_bytes(name.encode() * 100)
+            self.paths.append(str(path))
+        self.images = [(2, 0, self.paths[0]), (2, 1, self.paths[1])]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_fingerprint_ignores_names_and_exact_engines(self):
+        other = self.config.model_copy(deep=True)
+        other.color_data.names = ["renamed"]
+        other.labeling.engine = "blas"
+        self.assertEqual(other.fingerprint(), self.config.fingerprint())
+        other.det_params[0].thresh.step += 1
+        self.assertNotEqual(other.fingerprint(), self.config.fingerprint())
+
+    def test_counts_follow_the_content(self):
+        cache = ResultCache(self.db, self.config)
+        found, missing = cache.lookup(self.images)
+        self.assertEqual(found, [])
+        self.assertEqual(missing[(2, 0)][1], [None])
+        cache.add(missing[(2, 0)][0], [4])
+        cache.close()
+        # the same image, moved, is found again
+        moved = self.root.joinpath("moved.jpg")
+        os.replace(self.paths[0], moved)
+        cache = ResultCache(self.db, self.config)
+        found, missing = cache.lookup([(3, 1, str(moved)), self.images[1]])
+        self.assertEqual(found, [(3, 1, [4])])
+        self.assertEqual(list(missing), [(2, 1)])
+        # but not with other settings
+        self.config.det_params[0].thresh.step += 1
+        other = ResultCache(self.db, self.config)
+        self.assertEqual(other.lookup([(3, 1, str(moved))])[0], [])
+        other.close()
+        cache.close()
+
+    def test_renamed_image_is_found_by_content(self):
+        cache = ResultCache(self.db, self.config)
+        _, missing = cache.lookup(self.images[:1])
+        image_hash = missing[(2, 0)][0]
+        cache.add(image_hash, [4])
+        cache.flush()
+        renamed = self.root.joinpath("renamed.jpg")
+        os.replace(self.paths[0], renamed)
+        found, missing = cache.lookup([(2, 0, str(renamed))])
+        self.assertEqual((found, missing), ([(2, 0, [4])], {}))
+        # the hash of the new path is kept, it is not read again
+        path = str(renamed.resolve())
+        row = cache.connection.execute(
+            "SELECT hash FROM hashes WHERE path = ?", (path,)
+        ).fetchone()
+        self.assertEqual(row[0], image_hash)
+        cache.close()
+
+    def test_only_changed_colors_are_missing(self):
+        second = self.config.det_params[0].model_copy(deep=True)
+        self.config.det_params.append(second)
+        cache = ResultCache(self.db, self.config)
+        _, missing = cache.lookup(self.images[:1])
+        cache.add(missing[(2, 0)][0], [4, 7])
+        cache.close()
+        self.config.det_params[1].thresh.step += 1
+        cache = ResultCache(self.db, self.config)
+        found, missing = cache.lookup(self.images[:1])
+        self.assertEqual(found, [])
+        self.assertEqual(missing[(2, 0)][1], [4, None])
+        cache.close()
+
+    def test_unreadable_image_is_left_to_the_workers(self):
+        cache = ResultCache(self.db, self.config)
+        missing_file = str(self.root.joinpath("missing.jpg"))
+        found, missing = cache.lookup([(2, 0, missing_file)])
+        self.assertEqual((found, missing), ([], {}))
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+# Standard Python Library
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import sqlite3
+import unittest
+# Project files
+from spot_detector.file_utils import fetch_csv, fill_data_points, read_csv
+from spot_detector.results_store import ResultStore
+
+
+class Test_ResultStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.depths = ["0.0", "0.5"]
+        self.colors = ["orange", "vert"]
+        self.db_path = self.root.joinpath("results.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_processed_and_export(self):
+        store = ResultStore(self.db_path, self.depths, self.colors)
+        store.add("a", "0.0", [3, 4])
+        store.add("a", "0.5", [1, 0])
+        store.add("b", "0.5", [0, 7])
+        self.assertEqual(
+            store.processed(), {("a", "0.0"), ("a", "0.5"), ("b", "0.5")}
+        )
+        store.export_csv(self.root.joinpath("export.csv"), ["a", "b"])
+        store.close()
+
+        for name in ("a", "b"):
+            self.root.joinpath(name).mkdir()
+        sub_dirs = [self.root.joinpath("a"), self.root.joinpath("b")]
+        csv_file = fetch_csv(
+            self.root.joinpath("out.csv"), self.depths, self.colors, sub_dirs
+        )
+        table = read_csv(csv_file)
+        for data_points in [(2, 0, [3, 4]), (2, 1, [1, 0]), (3, 1, [0, 7])]:
+            fill_data_points(table, data_points, 2, 2)
+        expected = [[str(v) for v in row] for row in table]
+        self.assertEqual(read_csv(self.root.joinpath("export.csv")), expected)
+
+    def test_results_of_the_csv_file_are_kept(self):
+        for name in ("a", "b"):
+            self.root.joinpath(name).mkdir()
+        sub_dirs = [self.root.joinpath("a"), self.root.joinpath("b")]
+        csv_file = fetch_csv(
+            self.root.joinpath("out.csv"), self.depths, self.colors, sub_dirs
+        )
+        table = read_csv(csv_file)
+        fill_data_points(table, (2, 0, [3, 4]), 2, 2)
+        fill_data_points(table, (3, 1, [0, 7]), 2, 2)
+        store = ResultStore(self.db_path, self.depths, self.colors)
+        store.add("b", "0.5", [1, 1])
+        store.flush()
+        self.assertFalse(store.imported())
+        self.assertEqual(store.import_table(table), 2)
+        self.assertTrue(store.imported())
+        self.assertEqual(store.processed(), {("a", "0.0"), ("b", "0.5")})
+        store.export_csv(csv_file, ["a", "b"])
+        store.close()
+        expected = read_csv(csv_file)
+        self.assertEqual(expected[2][1:3], ["3", ""])
+        # the database wins over the csv file
+        self.assertEqual(expected[3][1:3], ["", "1"])
+        store = ResultStore(self.db_path, self.depths, self.colors)
+        self.assertTrue(store.imported())
+        store.close()
+
+    def test_readable_while_writing(self):
+        store = ResultStore(self.db_path, self.depths, self.colors)
+        store.add("a", "0.0", [3, 4])
+        store.flush()
+        reader = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            reader.execute("SELECT COUNT(*) FROM results").fetchone(), (2,)
+        )
+        reader.close()
+        store.close()
+
+    def test_other_layout_is_refused(self):
+        ResultStore(self.db_path, self.depths, self.colors).close()
+        with self.assertRaises(FileExistsError):
+            ResultStore(self.db_path, self.depths, ["orange"])
+
+
+if __name__ == "__main__":
+    unittest.main()
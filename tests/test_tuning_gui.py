@@ -0,0 +1,51 @@
+# Standard Python Library
+import unittest
+# Project files
+from spot_detector.config import DetParams
+from spot_detector.tuning_gui import AREA_LIMIT, apply_slider, slider_values
+
+
+class Test_sliders(unittest.TestCase):
+    def setUp(self):
+        self.settings = DetParams.from_prepopulated_defaults("orange")
+
+    def test_positions_of_the_settings(self):
+        positions = slider_values(self.settings)
+        self.assertEqual(positions["aire min"], 1)
+        self.assertEqual(positions["aire max"], 800)
+        self.assertEqual(positions["circularite %"], 50)
+        self.assertEqual(positions["pas du seuil"], 0)
+        self.settings.area.maxi = 10 * AREA_LIMIT
+        self.assertEqual(slider_values(self.settings)["aire max"], AREA_LIMIT)
+
+    def test_a_slider_only_changes_its_setting(self):
+        settings = apply_slider(self.settings, "aire min", 900)
+        self.assertEqual((settings.area.mini, settings.area.maxi), (900, None))
+        self.assertEqual(settings.circ, self.settings.circ)
+        self.assertEqual(self.settings.area.mini, 1.0)
+        settings = apply_slider(self.settings, "convexite %", 0)
+        self.assertFalse(settings.convex.enabled)
+        settings = apply_slider(self.settings, "pas du seuil", 8)
+        self.assertFalse(settings.thresh.automatic)
+        self.assertEqual(settings.thresh.step, 8)
+        settings = apply_slider(self.settings, "seuil min", 200)
+        self.assertFalse(settings.thresh.automatic)
+        self.assertEqual((settings.thresh.mini, settings.thresh.maxi),
+                         (200, 255))
+        settings = apply_slider(settings, "seuil max", 100)
+        self.assertEqual((settings.thresh.mini, settings.thresh.maxi),
+                         (99, 100))
+        self.assertEqual(slider_values(settings)["pas du seuil"],
+                         self.settings.thresh.step)
+        settings = apply_slider(settings, "composantes", 1)
+        self.assertEqual(settings.engine, "components")
+        for name, value in slider_values(settings).items():
+            with self.subTest(name=name):
+                self.assertEqual(
+                    slider_values(apply_slider(settings, name, value))[name],
+                    value,
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()